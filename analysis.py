@@ -0,0 +1,262 @@
+import argparse
+import csv
+import glob
+import multiprocessing
+import os
+import numpy as np
+from utils.ResultSink import load_npy_chunks
+
+
+# the metrics of each run, and those summarized for each (vbtx_ver, model, dataset, attr, deadline)
+RUN_METRICS = ["no_test", "no_disc", "unique_test", "unique_disc", "detection_rate", "unique_detection_rate",
+               "test_coverage", "test_diversity", "disc_coverage", "disc_diversity"]
+# constants of splitmix64, whose finalizer mixes the columns of a row into its hash
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def parse_run_name(name):
+    """parse the name of the result files of a run of exp.py, e.g., improved-NB-Adult-sex-1200-0
+    or, for a target of several (see Tester), improved-NB-Adult-sex,race-1200-race-0
+
+    Returns:
+        dict: the configuration of the run, or None if the name is not that of a run of exp.py
+    """
+    parts = name.split("-")
+    if len(parts) == 6:
+        vbtx_ver, model, dataset, attr, deadline, index = parts
+    elif len(parts) == 7:
+        vbtx_ver, model, dataset, _, deadline, attr, index = parts
+    else:
+        return None
+    if not deadline.isdigit() or not index.isdigit():
+        return None
+    return {"vbtx_ver": vbtx_ver, "model": model, "dataset": dataset, "attr": attr, "deadline": int(deadline), "index": int(index)}
+
+
+def find_runs(test_dir="TestData", disc_dir="DiscData"):
+    """find the runs whose results are in test_dir (and disc_dir), preferring the .npy chunks to the .csv file of a run
+
+    Returns:
+        list: (configuration, path of the test cases, path of the discriminatory instances or None) of each run
+    """
+    paths = dict()
+    for path in sorted(glob.glob(os.path.join(test_dir, "*.csv"))) + sorted(glob.glob(os.path.join(test_dir, "*-npy"))):
+        name = os.path.basename(path)
+        paths[name[:-len(".csv")] if name.endswith(".csv") else name[:-len("-npy")]] = path
+    runs = list()
+    for name, test_path in paths.items():
+        config = parse_run_name(name)
+        if config is None:
+            continue
+        disc_path = os.path.join(disc_dir, os.path.basename(test_path))
+        runs.append((config, test_path, disc_path if os.path.exists(disc_path) else None))
+    return runs
+
+
+def iter_csv_chunks(path, chunk_bytes=1 << 23):
+    """read the integer rows of a CSV file (as written by CSVSink) as arrays of about chunk_bytes bytes each"""
+    no_column = None
+    with open(path, 'rb') as file:
+        rest = b""
+        while True:
+            block = file.read(chunk_bytes)
+            data = rest + block
+            if block:
+                # the last line may continue in the next block
+                cut = data.rfind(b"\n") + 1
+                data, rest = data[:cut], data[cut:]
+            data = data.strip()
+            if data:
+                if no_column is None:
+                    no_column = data.split(b"\n", 1)[0].count(b",") + 1
+                values = np.fromstring(data.replace(b"\r\n", b",").replace(b"\n", b",").decode(), dtype=np.int64, sep=",")
+                yield values.reshape(-1, no_column)
+            if not block:
+                break
+
+
+def iter_npy_chunks(path, chunk_rows=1 << 17):
+    """read the rows of the .npy chunks written by NpySink (memory-mapped) as arrays of at most chunk_rows rows each"""
+    for chunk in load_npy_chunks(path):
+        for start in range(0, len(chunk), chunk_rows):
+            yield np.asarray(chunk[start:start + chunk_rows], dtype=np.int64)
+
+
+def iter_pairs(path, chunk_bytes=1 << 23):
+    """read the test cases (or discriminatory instances) in path as arrays of shape (pairs, 2, attributes + 1)"""
+    # about 128 bytes per row of .npy chunks
+    chunks = iter_npy_chunks(path, max(1, chunk_bytes // 128)) if os.path.isdir(path) else iter_csv_chunks(path, chunk_bytes)
+    odd = None # the first row of a pair split between two chunks
+    for rows in chunks:
+        if odd is not None:
+            rows = np.concatenate((odd, rows))
+            odd = None
+        if len(rows) % 2:
+            rows, odd = rows[:-1], rows[-1:]
+        if len(rows):
+            yield rows.reshape(len(rows) // 2, 2, -1)
+
+
+def hash_rows(rows):
+    """64-bit hashes of the rows of an integer array (rows with the same hash are taken as equal; collisions are negligible)"""
+    hashes = np.full(len(rows), GOLDEN, dtype=np.uint64)
+    for column in rows.T.astype(np.uint64):
+        hashes = (hashes ^ column) + GOLDEN
+        hashes = (hashes ^ (hashes >> np.uint64(30))) * MIX1
+        hashes = (hashes ^ (hashes >> np.uint64(27))) * MIX2
+        hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+class PairStats:
+    """the counts, unique pairs and value histograms of a stream of test cases (or discriminatory instances)
+
+    The unique pairs, whose two individuals are unordered, are kept as their 64-bit hashes, and the values of the attributes
+    of the first individual of each unique pair as one histogram per attribute over data_range (values outside of it are clipped),
+    so that the memory used does not depend on the number of rows, but on the number of unique pairs.
+    """
+    def __init__(self, data_range):
+        self.lower = np.asarray(data_range, dtype=np.int64)[:, 0]
+        self.width = np.asarray(data_range, dtype=np.int64)[:, 1] - self.lower
+        # the histograms of all the attributes side by side, the values of attribute i starting at self.start[i]
+        self.start = np.concatenate(([0], np.cumsum(self.width + 1)[:-1]))
+        self.histogram = np.zeros(int((self.width + 1).sum()), dtype=np.int64)
+        self.seen = np.zeros(0, dtype=np.uint64) # the sorted hashes of the unique pairs
+        self.no_pair = 0
+
+    def update(self, pairs):
+        self.no_pair += len(pairs)
+        # the attributes of each individual, without the output of the decision tree in the last column
+        rows = hash_rows(pairs[:, :, :-1].reshape(2 * len(pairs), -1)).reshape(len(pairs), 2)
+        # the two individuals of a pair are unordered: the pair is hashed from the sorted hashes of its individuals,
+        # and the individual with the smaller hash is its first one
+        swapped = rows[:, 0] > rows[:, 1]
+        rows.sort(axis=1)
+        hashes, first = np.unique(hash_rows(rows), return_index=True)
+        new = np.ones(len(hashes), dtype=bool)
+        if len(self.seen):
+            positions = np.minimum(np.searchsorted(self.seen, hashes), len(self.seen) - 1)
+            new = self.seen[positions] != hashes
+        self.seen = np.union1d(self.seen, hashes[new])
+        values = np.clip(pairs[first[new], swapped[first[new]].astype(np.int64), :-1] - self.lower, 0, self.width)
+        self.histogram += np.bincount((values + self.start).ravel(), minlength=len(self.histogram))
+
+    def coverage(self):
+        """the mean over the attributes of the fraction of the values of its range taken by the unique pairs"""
+        if len(self.seen) == 0:
+            return 0.0
+        covered = np.add.reduceat((self.histogram > 0).astype(np.int64), self.start)
+        return float((covered / (self.width + 1)).mean())
+
+    def diversity(self):
+        """the mean distance between two unique pairs (their first individuals), where the distance is the mean over
+        the attributes of the absolute difference of the values divided by the width of the range (from 0 to 1)
+        """
+        n = len(self.seen)
+        if n < 2:
+            return 0.0
+        distances = list()
+        for start, width in zip(self.start.tolist(), self.width.tolist()):
+            if width == 0:
+                distances.append(0.0)
+                continue
+            # the sum of |x - y| over the pairs of values is the sum, over the gaps between consecutive values v and v + 1,
+            # of the number of pairs on either side of the gap
+            below = np.cumsum(self.histogram[start:start + width])
+            distances.append(float((below * (n - below)).sum()) / (n * (n - 1) / 2) / width)
+        return float(np.mean(distances))
+
+
+def analyze_run(run, chunk_bytes=1 << 23):
+    """compute the metrics of a run, found by find_runs
+
+    Returns:
+        dict: the configuration and the metrics of the run
+    """
+    from exp import load_metadata
+    config, test_path, disc_path = run
+    _, data_range = load_metadata(config["dataset"])
+    stats = dict()
+    for kind, path in [("test", test_path), ("disc", disc_path)]:
+        stats[kind] = PairStats(data_range)
+        if path is not None:
+            for pairs in iter_pairs(path, chunk_bytes):
+                stats[kind].update(pairs)
+    no_test, no_disc = stats["test"].no_pair, stats["disc"].no_pair
+    unique_test, unique_disc = len(stats["test"].seen), len(stats["disc"].seen)
+    return dict(config, no_test=no_test, no_disc=no_disc, unique_test=unique_test, unique_disc=unique_disc,
+                detection_rate=no_disc / no_test if no_test else 0.0,
+                unique_detection_rate=unique_disc / unique_test if unique_test else 0.0,
+                test_coverage=stats["test"].coverage(), test_diversity=stats["test"].diversity(),
+                disc_coverage=stats["disc"].coverage(), disc_diversity=stats["disc"].diversity())
+
+
+def analyze_run_args(args):
+    return analyze_run(*args)
+
+
+def analyze_runs(runs, processes=None, chunk_bytes=1 << 23):
+    """compute the metrics of the runs on processes (default: the number of CPUs) workers, each reading one run at a time"""
+    processes = os.cpu_count() if processes is None else processes
+    results = list()
+    with multiprocessing.Pool(processes=processes) as pool:
+        for i, result in enumerate(pool.imap_unordered(analyze_run_args, [(run, chunk_bytes) for run in runs]), 1):
+            results.append(result)
+            if i % 100 == 0 or i == len(runs):
+                print(f"Analyzed {i}/{len(runs)} runs", flush=True)
+    results.sort(key=lambda result: (result["vbtx_ver"], result["model"], result["dataset"], result["attr"], result["deadline"], result["index"]))
+    return results
+
+
+def summarize(results):
+    """the mean and the standard deviation of each metric over the runs of each (vbtx_ver, model, dataset, attr, deadline)
+
+    The runs of different deadlines are summarized separately, as the counts grow with the runtime.
+    """
+    groups = dict()
+    for result in results:
+        groups.setdefault((result["vbtx_ver"], result["model"], result["dataset"], result["attr"], result["deadline"]), []).append(result)
+    summary = list()
+    for (vbtx_ver, model, dataset, attr, deadline), group in sorted(groups.items()):
+        metrics = np.array([[result[metric] for metric in RUN_METRICS] for result in group], dtype=float)
+        row = {"vbtx_ver": vbtx_ver, "model": model, "dataset": dataset, "attr": attr, "deadline": deadline, "runs": len(group)}
+        for metric, mean, std in zip(RUN_METRICS, metrics.mean(axis=0), metrics.std(axis=0)):
+            row[metric + "_mean"], row[metric + "_std"] = float(mean), float(std)
+        summary.append(row)
+    return summary
+
+
+def save_table(path, rows):
+    with open(path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="summarize the results of exp.py in TestData and DiscData")
+    parser.add_argument("--test-dir", default="TestData", help="the folder of the test cases (default: %(default)s)")
+    parser.add_argument("--disc-dir", default="DiscData", help="the folder of the discriminatory instances (default: %(default)s)")
+    parser.add_argument("--output", default="Analysis", help="the folder of the tables (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=None, help="the number of worker processes (default: the number of CPUs)")
+    parser.add_argument("--chunk-mb", type=int, default=8, help="the size of the chunks read from the files in MB (default: %(default)s)")
+    args = parser.parse_args()
+
+    runs = find_runs(args.test_dir, args.disc_dir)
+    if not runs:
+        print(f"No results of exp.py in {args.test_dir}")
+        exit()
+    results = analyze_runs(runs, args.processes, args.chunk_mb << 20)
+    summary = summarize(results)
+    os.makedirs(args.output, exist_ok=True)
+    save_table(os.path.join(args.output, "runs.csv"), results)
+    save_table(os.path.join(args.output, "summary.csv"), summary)
+    print(f"{'vbtx_ver':<12} {'model':<10} {'dataset':<8} {'attr':<10} {'deadline':>8} {'runs':>4} {'#Test':>9} {'#Disc':>9} {'unique disc':>11} "
+          f"{'disc/test':>9} {'coverage':>8} {'diversity':>9}")
+    for row in summary:
+        print(f"{row['vbtx_ver']:<12} {row['model']:<10} {row['dataset']:<8} {row['attr']:<10} {row['deadline']:>8} {row['runs']:>4} "
+              f"{row['no_test_mean']:>9.0f} {row['no_disc_mean']:>9.0f} {row['unique_disc_mean']:>11.0f} "
+              f"{row['detection_rate_mean']:>9.3f} {row['disc_coverage_mean']:>8.3f} {row['disc_diversity_mean']:>9.3f}")
+    print(f"Saved the metrics of each run to {args.output}/runs.csv and the summary to {args.output}/summary.csv")
@@ -0,0 +1,194 @@
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import time
+import numpy as np
+from utils.Telemetry import load_telemetry
+
+
+# the default grid: one (dataset, protected attribute, model) configuration per dataset
+DEFAULT_GRID = ["Adult:sex:NB", "Credit:age:LogReg", "Bank:age:DecTree"]
+DEFAULT_VERSIONS = ["naive", "improveds10", "improved", "box"]
+# stages of Z3 checks in the telemetry (see utils.Telemetry)
+Z3_STAGES = ["z3_base_check", "z3_sat", "z3_unsat", "z3_unknown"]
+
+
+def bench_unit(dataset_name, protected_attr, model_name, vbtx_ver, max_test_data, seed, max_time=None):
+    """run one benchmark unit (in its own process, so that the peak RSS is that of this unit)
+
+    The run stops after max_time seconds (None: no limit) even if it has not generated max_test_data test cases,
+    e.g., if the approximation models never yield a solution.
+
+    Returns:
+        dict: the metrics of the run
+    """
+    from exp import PROTECTED_ATTRS, create_black_box_model
+    from vbtx import Tester
+    black_model = create_black_box_model(dataset_name, model_name)
+    tester = Tester(black_model, [PROTECTED_ATTRS[dataset_name][protected_attr]], no_train_data_sample=5000,
+                    vbtx_ver=vbtx_ver, seed=seed, output_format=(), keep_results=False, telemetry=True)
+    label = (f"bench-{vbtx_ver}-{model_name}-{dataset_name}-{protected_attr}", seed)
+    start_time = time.time()
+    tester.test(deadline=max_time, max_test_data=max_test_data, label=label)
+    runtime = time.time() - start_time
+
+    records = load_telemetry(os.path.join("Telemetry", f"{label[0]}-{label[1]}.jsonl"))
+    loop_time = np.array([record["stages"]["loop"]["wall"] for record in records])
+    z3_time = sum(record["stages"][stage]["wall"] for record in records for stage in Z3_STAGES if stage in record["stages"])
+    # the loop metrics of a run without any complete loop are None
+    no_loop = len(records) == 0
+    return {"dataset": dataset_name, "attr": protected_attr, "model": model_name, "vbtx_ver": vbtx_ver, "seed": seed,
+            "runtime": runtime, "timed_out": tester.no_test < max_test_data,
+            "no_loop": len(records), "no_test": tester.no_test, "no_disc": tester.no_disc,
+            "unique_test": len(tester.test_index), "unique_disc": len(tester.disc_index),
+            "tests_per_sec": tester.no_test / runtime, "unique_disc_per_sec": len(tester.disc_index) / runtime,
+            # the latency that matters to a consumer stopping at the first finding (None: no discriminatory instance)
+            "first_disc_time": tester.first_disc_time,
+            "loop_mean": None if no_loop else float(loop_time.mean()),
+            "loop_p50": None if no_loop else float(np.percentile(loop_time, 50)),
+            "loop_p95": None if no_loop else float(np.percentile(loop_time, 95)),
+            "z3_share": None if no_loop or loop_time.sum() == 0 else z3_time / float(loop_time.sum()),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def format_time(seconds):
+    return "none" if seconds is None else f"{seconds:.2f}s"
+
+
+def format_ms(seconds):
+    return "none" if seconds is None else f"{1000 * seconds:.0f}ms"
+
+
+def format_share(share):
+    return "none" if share is None else f"{100 * share:.0f}%"
+
+
+def config_key(result):
+    return f"{result['vbtx_ver']}-{result['model']}-{result['dataset']}-{result['attr']}"
+
+
+def unit_key(result):
+    return f"{config_key(result)}-{result['seed']}"
+
+
+def median_first_disc_time(results):
+    """the median over the seeds of the time to the first discriminatory instance of each configuration (inf: none found)"""
+    times = dict()
+    for result in results:
+        # baselines saved before first_disc_time was measured do not have it
+        if "first_disc_time" in result:
+            first = result["first_disc_time"]
+            times.setdefault(config_key(result), list()).append(float("inf") if first is None else first)
+    return {key: float(np.median(values)) for key, values in times.items()}
+
+
+def run_benchmark(grid, versions, seeds, max_test_data, max_time=None):
+    results = list()
+    for vbtx_ver in versions:
+        for config in grid:
+            dataset_name, protected_attr, model_name = config.split(":")
+            for seed in seeds:
+                # a fresh process for each unit, one at a time so that the units do not compete for CPU
+                with multiprocessing.Pool(processes=1, maxtasksperchild=1) as pool:
+                    result = pool.apply(bench_unit, (dataset_name, protected_attr, model_name, vbtx_ver, max_test_data, seed, max_time))
+                results.append(result)
+                print(f"{unit_key(result)}: {result['runtime']:.2f}s, {result['tests_per_sec']:.1f} tests/s, "
+                      f"{result['unique_disc_per_sec']:.1f} unique disc/s, loop {format_ms(result['loop_mean'])} "
+                      f"(p95 {format_ms(result['loop_p95'])}), first disc {format_time(result['first_disc_time'])}, "
+                      f"Z3 {format_share(result['z3_share'])}, peak RSS {result['peak_rss_mb']:.0f}MB"
+                      + (f" (stopped by --max-time with {result['no_test']} test cases)" if result["timed_out"] else ""))
+    return results
+
+
+def compare(results, baseline, tolerance, first_disc_floor=1.0):
+    """compare the results with the baseline, and return the regressions
+
+    A unit regresses if its throughput (tests/sec or unique disc/sec) falls below (1 - tolerance) times the baseline,
+    or its mean loop latency exceeds (1 + tolerance) times the baseline.
+    A unit stopped by --max-time before generating all its test cases regresses unless the baseline was stopped as well.
+    The time to the first discriminatory instance, a single and often sub-second sample of each unit, is only reported per unit:
+    a configuration regresses if its median over the seeds exceeds (1 + tolerance) times that of the baseline
+    by first_disc_floor seconds or more (a configuration that finds none in most seeds, while the baseline does, also regresses).
+    """
+    first_medians, base_first_medians = median_first_disc_time(results), median_first_disc_time(baseline)
+    baseline = {unit_key(result): result for result in baseline}
+    regressions = list()
+    print(f"{'unit':<40} {'tests/s':>16} {'unique disc/s':>16} {'loop ms':>16} {'first disc s':>16}")
+    for result in results:
+        base = baseline.get(unit_key(result))
+        if base is None:
+            print(f"{unit_key(result):<40} (not in the baseline)")
+            continue
+        ratios = {metric: result[metric] / base[metric] if base[metric] > 0 else float("inf")
+                  for metric in ["tests_per_sec", "unique_disc_per_sec"]}
+        print(f"{unit_key(result):<40}" + "".join(f" {result[metric]:>8.1f} ({ratio:5.2f}x)" for metric, ratio in ratios.items()), end="")
+        # a run without any complete loop has no loop latency
+        loop, base_loop = result["loop_mean"], base["loop_mean"]
+        loop_ratio = None
+        if loop is not None and base_loop:
+            loop_ratio = loop / base_loop
+            print(f" {1000 * loop:>8.0f} ({loop_ratio:5.2f}x)", end="")
+        else:
+            print(f" {format_ms(loop):>16}", end="")
+        first, base_first = result["first_disc_time"], base.get("first_disc_time")
+        if base_first is not None:
+            first_ratio = float("inf") if first is None else first / base_first
+            print(f" {format_time(first):>8} ({first_ratio:5.2f}x)")
+        else:
+            print(f" {format_time(first):>8}")
+        # baselines saved before --max-time was added were not stopped
+        timed_out = result["timed_out"] and not base.get("timed_out", False)
+        if timed_out:
+            print(f"{'':<40} stopped by --max-time with {result['no_test']} test cases")
+        if ratios["tests_per_sec"] < 1 - tolerance or ratios["unique_disc_per_sec"] < 1 - tolerance \
+                or (loop_ratio is not None and loop_ratio > 1 + tolerance) or timed_out:
+            regressions.append(unit_key(result))
+    for key, first in first_medians.items():
+        base_first = base_first_medians.get(key, float("inf"))
+        if base_first == float("inf"):
+            continue
+        if first > (1 + tolerance) * base_first and first - base_first >= first_disc_floor:
+            print(f"{key}: median first disc {format_time(None if first == float('inf') else first)} "
+                  f"over the seeds, against {format_time(base_first)} in the baseline")
+            regressions.append(f"{key} (first disc)")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark VBT-X for a fixed number of test cases")
+    parser.add_argument("--grid", default=",".join(DEFAULT_GRID),
+                        help="comma-separated dataset:protected_attr:model configurations (default: %(default)s)")
+    parser.add_argument("--versions", default=",".join(DEFAULT_VERSIONS), help="comma-separated versions of VBT-X (default: %(default)s)")
+    parser.add_argument("--seeds", default="0", help="comma-separated seeds (default: %(default)s)")
+    parser.add_argument("--max-test-data", type=int, default=2000, help="the number of test cases of each run (default: %(default)s)")
+    parser.add_argument("--max-time", type=float, default=600,
+                        help="the time limit of each run in seconds, reached only if it cannot generate its test cases (default: %(default)s)")
+    parser.add_argument("--output", default="Benchmark/latest.json", help="where to save the results (default: %(default)s)")
+    parser.add_argument("--baseline", default="Benchmark/baseline.json", help="the results to compare with (default: %(default)s)")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="the relative slowdown counted as a regression (default: %(default)s)")
+    parser.add_argument("--first-disc-floor", type=float, default=1.0,
+                        help="the smallest slowdown of the median time to the first discriminatory instance counted as a regression, "
+                             "in seconds (default: %(default)s)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.grid.split(","), args.versions.split(","), [int(seed) for seed in args.seeds.split(",")],
+                            args.max_test_data, args.max_time)
+    os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(results, file, indent=1)
+        print(f"Saved the baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance, args.first_disc_floor)
+        if regressions:
+            print(f"Regressions: {', '.join(regressions)}")
+            exit(1)
+    else:
+        print(f"No baseline at {args.baseline}; run with --save-baseline to create one")
@@ -1,106 +1,220 @@
-from vbtx import *
+import json
 import multiprocessing
-from joblib import load
-import pandas as pd
+import os
 import sys
+import time
+from utils.Checkpoint import load_checkpoint, checkpoint_path
+# vbtx (sklearn, z3), numpy and joblib are imported where they are used, so that, e.g., printing the usage starts fast
 
 
-def exp(dataset_name, model_name, protected_pair, vbtx_ver, deadline, repeat, show_logging):
-    protected_name = protected_pair[0]
-    protected_param = protected_pair[1]
+# the file name (in ./Datasets) and the protected attributes (name -> index of the attribute) of each dataset
+DATASET_CSV = {"Adult": "Adult", "Credit": "GermanCredit", "Bank": "Bank"}
+PROTECTED_ATTRS = {
+    "Adult": {"sex": 8, "race": 7, "age": 0},
+    "Credit": {"sex": 8, "age": 12},
+    "Bank": {"age": 0},
+}
+# the column names and the range of each column of the datasets, computed once from the CSV files
+METADATA_PATH = "Datasets/metadata.json"
 
-    # create black box model
-    dataset_csv = "GermanCredit" if dataset_name == "Credit" else dataset_name
-    data_range = []
-    df = pd.read_csv(f"./Datasets/{dataset_csv}.csv")
-    number_attr = df.shape[1] - 1
-    for i in range(0, number_attr):
-        min_ = df.iloc[:, i].min()
-        max_ = df.iloc[:, i].max()
-        data_range += [[min_, max_]]
 
-    MODEL_ = load(f"FairnessTestCases/{model_name}{dataset_name}.joblib")
+def load_metadata(dataset_name):
+    """return the column names and the range of each attribute of the dataset, from the metadata cache if it is up to date"""
+    csv_path = f"Datasets/{DATASET_CSV[dataset_name]}.csv"
+    metadata = dict()
+    if os.path.exists(METADATA_PATH):
+        with open(METADATA_PATH) as file:
+            metadata = json.load(file)
+    entry = metadata.get(dataset_name)
+    if entry is None or entry["mtime"] != os.path.getmtime(csv_path):
+        import numpy as np
+        with open(csv_path) as file:
+            columns = file.readline().strip().split(",")
+        data = np.loadtxt(csv_path, delimiter=",", skiprows=1, dtype=np.int64, ndmin=2)
+        entry = {"mtime": os.path.getmtime(csv_path), "columns": columns,
+                 "data_range": np.column_stack((data.min(axis=0), data.max(axis=0)))[:-1].tolist()}
+        metadata[dataset_name] = entry
+        # write to a temporary file first, as several processes may update the cache at the same time
+        with open(f"{METADATA_PATH}.{os.getpid()}", 'w') as file:
+            json.dump(metadata, file, indent=1)
+        os.replace(f"{METADATA_PATH}.{os.getpid()}", METADATA_PATH)
+    return entry["columns"], entry["data_range"]
+
+
+def create_black_box_model(dataset_name, model_name, mmap_mode=None):
+    """load a model of FairnessTestCases as a black box model
+
+    With mmap_mode="r", the arrays of the model are memory-mapped, so that the processes loading the same model share their pages.
+    This is only worth it for large models pickled with aligned arrays: the bundled models are old pickles whose arrays are
+    not aligned (joblib warns that mapping them may crash), and scikit-learn copies the arrays of trees when loading anyway.
+    """
+    import numpy as np
+    from joblib import load
+    from vbtx import BlackBoxModel
+    # the input domain of the model is the range of each attribute in the dataset
+    feature_list, data_range = load_metadata(dataset_name)
+
+    MODEL_ = load(f"FairnessTestCases/{model_name}{dataset_name}.joblib", mmap_mode=mmap_mode)
     def predict_func(inputs):
-        inputs = [[int(item) for item in row] for row in inputs]
-        return MODEL_.predict(inputs)
-    black_model = BlackBoxModel(data_range, predict_func, feature_list=df.columns.tolist())
+        return MODEL_.predict(np.asarray(inputs, dtype=np.int64))
+    return BlackBoxModel(data_range, predict_func, feature_list=feature_list)
+
+
+def parse_protected(dataset_name, protected_attr):
+    """parse protected_attr, e.g., "sex" or, for several targets (see Tester), "sex,race,sex+race"
+
+    Returns:
+        tuple: protected_attr and the index of the attribute (for one attribute) or the list of targets
+    """
+    targets = list()
+    for target in protected_attr.split(","):
+        for name in target.split("+"):
+            if name not in PROTECTED_ATTRS[dataset_name]:
+                print(f"no protected attribute called {name}")
+                print_usage()
+                exit()
+        targets.append([PROTECTED_ATTRS[dataset_name][name] for name in target.split("+")])
+    if len(targets) == 1 and len(targets[0]) == 1:
+        return protected_attr, targets[0][0]
+    return protected_attr, targets
+
+
+# black box models loaded by this process, shared by all the units it runs
+black_box_models = dict()
+
+
+def get_black_box_model(dataset_name, model_name):
+    if (dataset_name, model_name) not in black_box_models:
+        black_box_models[(dataset_name, model_name)] = create_black_box_model(dataset_name, model_name)
+    return black_box_models[(dataset_name, model_name)]
+
+
+# pools of labeled inputs opened by this process, see get_train_pool
+train_pools = dict()
+
+
+def get_train_pool(dataset_name, model_name):
+    """the pool of inputs labeled by a model, shared by all the units (and processes) testing it
+
+    The pool is emptied and labeled again if the model file (its size and modification time) or the data range has changed.
+    """
+    if (dataset_name, model_name) not in train_pools:
+        from utils.LabeledPool import LabeledPool
+        feature_list, data_range = load_metadata(dataset_name)
+        model_path = f"FairnessTestCases/{model_name}{dataset_name}.joblib"
+        source = {"model": model_path, "model_size": os.path.getsize(model_path), "model_mtime": os.path.getmtime(model_path),
+                  "data_range": [[int(lower), int(upper)] for lower, upper in data_range]}
+        pool = LabeledPool(f"TrainPool/{model_name}{dataset_name}.bin", len(feature_list), source=source)
+        if pool.rebuilt:
+            print(f"The model or the data of {model_name}{dataset_name} have changed: its pool of labeled inputs is labeled again")
+        train_pools[(dataset_name, model_name)] = pool
+    return train_pools[(dataset_name, model_name)]
+
 
+def unit_label(dataset_name, model_name, protected_pair, vbtx_ver, deadline, index):
+    return f"{vbtx_ver}-{model_name}-{dataset_name}-{protected_pair[0]}-{deadline}", index
+
+
+def run_unit(dataset_name, model_name, protected_pair, vbtx_ver, deadline, index, show_logging=False, checkpoint_interval=60,
+             train_pool=False, fresh=False):
+    """run the index-th repeat of a configuration
+
+    A repeat completed before is skipped, and a repeat interrupted before resumes from its checkpoint, unless fresh.
+    With train_pool, the training data are drawn from the pool of inputs labeled by the model (see get_train_pool).
+
+    Returns:
+        tuple: the numbers of test cases and discriminatory instances
+    """
+    from vbtx import Tester
+    # protected_pair[1] is the index of a protected attribute, or a list of targets (see Tester)
+    protected_list = protected_pair[1] if isinstance(protected_pair[1], list) else [protected_pair[1]]
+    tester = Tester(get_black_box_model(dataset_name, model_name), protected_list, no_train_data_sample=5000,
+                    vbtx_ver=vbtx_ver, show_logging=show_logging,
+                    train_pool=get_train_pool(dataset_name, model_name) if train_pool else None)
+    tester.test(deadline=deadline, label=unit_label(dataset_name, model_name, protected_pair, vbtx_ver, deadline, index),
+                checkpoint_interval=checkpoint_interval, resume=not fresh)
+    return tester.no_test, tester.no_disc
+
+
+def run_unit_args(args):
+    unit, options = args
+    return unit, run_unit(*unit, **options)
+
+
+def exp(dataset_name, model_name, protected_pair, vbtx_ver, deadline, repeat, show_logging, train_pool=False, fresh=False):
     # perform fairness testing
     for _ in range(repeat):
-        tester = Tester(black_model, [protected_param], no_train_data_sample=5000, vbtx_ver=vbtx_ver, show_logging=show_logging)
-        tester.test(deadline=deadline, label=(f"{vbtx_ver}-{model_name}-{dataset_name}-{protected_name}-{deadline}", _))
+        run_unit(dataset_name, model_name, protected_pair, vbtx_ver, deadline, _, show_logging, train_pool=train_pool, fresh=fresh)
+
+
+def unit_cost(unit):
+    # the runtime of a unit is its deadline; among the units of the same deadline, those of larger models go first
+    dataset_name, model_name, protected_pair, vbtx_ver, deadline, index = unit
+    return deadline, os.path.getsize(f"FairnessTestCases/{model_name}{dataset_name}.joblib")
 
 
-def para_exp_main(deadline=1200, repeat=31):
+def para_exp_main(deadline=1200, repeat=31, processes=None, train_pool=False, fresh=False):
+    """run all the configurations as a queue of (configuration, repeat) units on processes (default: the number of CPUs) workers"""
     check_models = ["LogReg",  "NB", "RanForest", "DecTree"]
     dataset_names = ["Adult", "Credit", "Bank"]
     vbtx_ver_list = ["naive", "improveds10", "improved"]
-    paras = list()
+    units = list()
     for vbtx_ver in vbtx_ver_list:
         for dataset_name in dataset_names:
-            protected_list = list()
-            if dataset_name == "Adult":
-                protected_list = [("sex", 8), ("race", 7), ("age", 0)]
-            elif dataset_name == "Bank":
-                protected_list = [("age", 0)]
-            elif dataset_name == "Credit":
-                protected_list = [("sex", 8), ("age", 12)]
-            for protected_pair in protected_list:
+            for protected_pair in PROTECTED_ATTRS[dataset_name].items():
                 for model_name in check_models:
-                    paras.append((dataset_name, model_name, protected_pair, vbtx_ver, deadline, repeat, False))
-    pool = multiprocessing.Pool(processes=6)
-    pool.starmap(exp, paras)
-    pool.close()
-    pool.join()
+                    for index in range(repeat):
+                        unit = (dataset_name, model_name, protected_pair, vbtx_ver, deadline, index)
+                        # the units completed before are not scheduled again, unless fresh
+                        state = None if fresh else load_checkpoint(checkpoint_path(unit_label(*unit)))
+                        if state is None or not state["completed"]:
+                            units.append(unit)
+    # longest first, so that no long unit is left to run alone at the end
+    units.sort(key=unit_cost, reverse=True)
+    total_time = sum(unit_cost(unit)[0] for unit in units)
+    done_time = 0
+    start_time = time.time()
+    processes = os.cpu_count() if processes is None else processes
+    print(f"Running {len(units)} units on {processes} processes")
+    with multiprocessing.Pool(processes=processes) as pool:
+        for i, (unit, (no_test, no_disc)) in enumerate(pool.imap_unordered(run_unit_args, [(unit, {"train_pool": train_pool, "fresh": fresh}) for unit in units]), 1):
+            done_time += unit_cost(unit)[0]
+            elapsed = time.time() - start_time
+            label = unit_label(*unit)
+            print(f"[{i}/{len(units)}] {label[0]}-{label[1]}: #Test={no_test}, #Disc={no_disc} -- "
+                  f"elapsed {elapsed:.0f}s, ETA {elapsed * (total_time - done_time) / done_time:.0f}s", flush=True)
 
 def print_usage():
-    print("Usage: python exp.py dataset protected_attr model vbtx_ver [runtime] [loop_times]")
+    print("Usage: python exp.py dataset protected_attr model vbtx_ver [runtime] [loop_times] [--train-pool] [--fresh]")
+    print("       python exp.py all [--train-pool] [--fresh]")
     print("The possible values for each parameter are listed below:")
-    print("- dataset and protected_attr pairs: (Adult,sex), (Adult,race), (Adult,age), (Credit,sex), (Credit,age) (Bank,age)")
+    print("- dataset and protected_attr pairs: " + ", ".join(f"({dataset_name},{protected_attr})"
+                                                             for dataset_name in PROTECTED_ATTRS for protected_attr in PROTECTED_ATTRS[dataset_name]))
+    print("  several protected attributes of a dataset are separated by commas, and their intersections are joined by +, e.g., sex,race,sex+race")
     print("- models: LogReg, NB, RanForest, DecTree")
-    print("- vbtx_ver: naive, improveds10, improved")
+    print("- vbtx_ver: naive, improveds10, improved, box")
+    print("--train-pool: draw the training data from the inputs labeled by the model in ./TrainPool, shared by all the runs")
+    print("--fresh: run again the runs completed (or interrupted) before, instead of skipping (or resuming) them from ./Checkpoint")
 
 if __name__ == "__main__":
-    # dataset and protected attribute pairs: ("Adult","sex"), ("Adult","race"), ("Adult","age"), ("Credit","sex"), ("Credit","age"), ("Bank","age")
-    # models: "LogReg", "NB", "RanForest", "DecTree"
-    # vbt versions: "naive", "improveds10", "improved"
+    train_pool = "--train-pool" in sys.argv
+    if train_pool:
+        sys.argv.remove("--train-pool")
+    fresh = "--fresh" in sys.argv
+    if fresh:
+        sys.argv.remove("--fresh")
     if len(sys.argv) == 2 and sys.argv[1] == "all":
-        para_exp_main(1200, 31)
+        para_exp_main(1200, 31, train_pool=train_pool, fresh=fresh)
+        exit()
     if len(sys.argv) not in [5, 6, 7]:
         print_usage()
         exit()
-    else:
-        attr_index = -1
-        dataset_name = sys.argv[1]
-        protected_attr = sys.argv[2]
-        if dataset_name == "Adult":
-            if protected_attr == "sex":
-                attr_index = 8
-            elif protected_attr == "race":
-                attr_index = 7
-            elif protected_attr == "age":
-                attr_index = 0
-            else:
-                print(f"no protected attribute called {protected_attr}")
-                print_usage()
-                exit()
-        elif dataset_name == "Bank":
-            if protected_attr == "age":
-                attr_index = 0
-            else:
-                print(f"no protected attribute called {protected_attr}")
-                print_usage()
-                exit()
-        elif dataset_name == "Credit":
-            if protected_attr == "sex":
-                attr_index = 8
-            elif protected_attr == "age":
-                attr_index = 12
-            else:
-                print(f"no protected attribute called {protected_attr}")
-                print_usage()
-                exit()
+    dataset_name, protected_attr, model_name, vbtx_ver = sys.argv[1:5]
+    if dataset_name not in PROTECTED_ATTRS:
+        print(f"no dataset called {dataset_name}")
+        print_usage()
+        exit()
     deadline = int(sys.argv[5]) if 5 < len(sys.argv) else 1200
     repeat = int(sys.argv[6]) if 6 < len(sys.argv) else 31
-    exp(dataset_name=sys.argv[1], model_name=sys.argv[3], protected_pair=(sys.argv[2], 8), vbtx_ver=sys.argv[4],
-        deadline=deadline, repeat=repeat, show_logging=True)
+    exp(dataset_name=dataset_name, model_name=model_name, protected_pair=parse_protected(dataset_name, protected_attr),
+        vbtx_ver=vbtx_ver, deadline=deadline, repeat=repeat, show_logging=True, train_pool=train_pool, fresh=fresh)
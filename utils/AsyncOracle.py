@@ -0,0 +1,180 @@
+import asyncio
+import json
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class AsyncOracle:
+    """asyncio client of a remote black box model, with request coalescing
+
+    The requests made within max_delay seconds are coalesced into batches of at most max_batch_size inputs,
+    and at most max_in_flight batches are sent at the same time.
+    A batch that does not return within timeout seconds (or fails) is retried up to retries times, with exponential backoff.
+
+    The event loop runs in a background thread, so the oracle can also be used from synchronous code:
+    an AsyncOracle object is callable as the predict_func of BlackBoxModel,
+    and submit returns a concurrent.futures.Future that can be waited for later.
+
+    Args:
+        predict_batch: an async function that takes a list of inputs and returns the list of their outputs
+    """
+    def __init__(self, predict_batch, max_batch_size=1000, max_in_flight=4, timeout=None, retries=0, backoff=0.1, max_delay=0.005):
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.no_batch = 0
+        self.no_retry = 0
+        self.loop = None
+        self.thread = None
+        self.pending = None
+        self.in_flight = None
+        self.coalescer = None
+
+    def start(self):
+        if self.loop is not None:
+            return
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.setup(), self.loop).result()
+
+    async def setup(self):
+        self.pending = asyncio.Queue()
+        self.in_flight = asyncio.Semaphore(self.max_in_flight)
+        self.coalescer = self.loop.create_task(self.coalesce())
+
+    def close(self):
+        if self.loop is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.loop = None
+
+    async def shutdown(self):
+        self.coalescer.cancel()
+        try:
+            await self.coalescer
+        except asyncio.CancelledError:
+            pass
+
+    async def predict(self, inputs):
+        """predict the outputs of the given inputs, sharing batches with concurrent requests"""
+        future = self.loop.create_future()
+        await self.pending.put(([list(map(int, row)) for row in inputs], future))
+        return await future
+
+    def submit(self, inputs):
+        """predict the outputs of the given inputs in the background, returning a concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(self.predict(inputs), self.loop)
+
+    def __call__(self, inputs):
+        return self.submit(inputs).result()
+
+    async def coalesce(self):
+        # collect the pending requests into batches, and dispatch each batch without waiting for its result
+        while True:
+            requests = [await self.pending.get()]
+            size = len(requests[0][0])
+            deadline = self.loop.time() + self.max_delay
+            while size < self.max_batch_size:
+                try:
+                    request = await asyncio.wait_for(self.pending.get(), max(0, deadline - self.loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                requests.append(request)
+                size += len(request[0])
+            self.loop.create_task(self.dispatch(requests))
+
+    async def dispatch(self, requests):
+        inputs = [row for rows, _ in requests for row in rows]
+        try:
+            chunks = [inputs[i:i + self.max_batch_size] for i in range(0, len(inputs), self.max_batch_size)]
+            results = await asyncio.gather(*[self.send(chunk) for chunk in chunks])
+            outputs = [output for result in results for output in result]
+        except Exception as e:
+            for _, future in requests:
+                future.set_exception(e)
+            return
+        start = 0
+        for rows, future in requests:
+            future.set_result(outputs[start:start + len(rows)])
+            start += len(rows)
+
+    async def send(self, batch):
+        for retry in range(self.retries + 1):
+            try:
+                async with self.in_flight:
+                    self.no_batch += 1
+                    return await asyncio.wait_for(self.predict_batch(batch), self.timeout)
+            except Exception:
+                if retry == self.retries:
+                    raise
+                self.no_retry += 1
+                await asyncio.sleep(self.backoff * 2 ** retry)
+
+
+def http_predict_batch(url):
+    """the async function that posts a batch of inputs as JSON ({"inputs": [...]}) to url and returns its "outputs" """
+    def post(batch):
+        request = urllib.request.Request(url, data=json.dumps({"inputs": batch}).encode(),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())["outputs"]
+
+    async def predict_batch(batch):
+        return await asyncio.get_running_loop().run_in_executor(None, post, batch)
+    return predict_batch
+
+
+class StandInServer:
+    """local HTTP server that serves a model with simulated latency, standing in for a remote black box model
+
+    It answers POST requests of {"inputs": [...]} with {"outputs": [...]} after sleeping for latency seconds.
+    """
+    def __init__(self, predict_func, latency=0.05, host="127.0.0.1", port=0):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                inputs = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["inputs"]
+                time.sleep(server.latency)
+                server.no_request += 1
+                body = json.dumps({"outputs": [int(output) for output in server.predict_func(inputs)]}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.predict_func = predict_func
+        self.latency = latency
+        self.no_request = 0
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
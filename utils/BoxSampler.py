@@ -0,0 +1,152 @@
+import numpy as np
+
+
+def tree_leaf_boxes(tree_, data_range, return_nodes=False):
+    """compute the box (i.e., hyper-rectangle) of each leaf of a decision tree
+
+    Each leaf of the tree covers the integer points whose i-th attribute lies in [lower[i], upper[i]].
+
+    Args:
+        tree_: the tree structure of a fitted DecisionTreeClassifier (DT.tree_)
+        data_range (list): the range of each attribute, e.g., [[1, 2], [3, 4]]
+        return_nodes (bool): whether to return the node ids of the leaves as well
+
+    Returns:
+        the lower bounds (n_leaves x n_attr), the upper bounds (n_leaves x n_attr) and the labels of the leaves
+        (and their node ids, if return_nodes), where the leaves that cannot be reached within data_range are omitted
+    """
+    data_range = np.asarray(data_range, dtype=np.int64)
+    feature = tree_.feature.tolist()
+    threshold = np.floor(tree_.threshold).astype(np.int64).tolist()
+    children_left = tree_.children_left.tolist()
+    children_right = tree_.children_right.tolist()
+    lowers, uppers, leaves = list(), list(), list()
+    stack = [(0, data_range[:, 0].copy(), data_range[:, 1].copy())]
+    while stack:
+        node, lower, upper = stack.pop()
+        if feature[node] != -2:
+            # a child is skipped if its box is empty on the split attribute
+            index = feature[node]
+            if children_right[node] != -1 and threshold[node] + 1 <= upper[index]:
+                right_lower = lower.copy()
+                right_lower[index] = max(right_lower[index], threshold[node] + 1)
+                stack.append((children_right[node], right_lower, upper))
+            if children_left[node] != -1 and lower[index] <= threshold[node]:
+                left_upper = upper.copy()
+                left_upper[index] = min(left_upper[index], threshold[node])
+                stack.append((children_left[node], lower, left_upper))
+        else:
+            lowers.append(lower)
+            uppers.append(upper)
+            leaves.append(node)
+    labels = np.argmax(tree_.value[leaves, 0], axis=1)
+    if return_nodes:
+        return np.array(lowers).reshape(-1, len(data_range)), np.array(uppers).reshape(-1, len(data_range)), labels, \
+            np.array(leaves, dtype=np.int64)
+    return np.array(lowers).reshape(-1, len(data_range)), np.array(uppers).reshape(-1, len(data_range)), labels
+
+
+def compatible_leaf_pairs(lower, upper, labels, protected_att):
+    """find the pairs of leaves that can yield a discriminatory instance
+
+    Two leaves are compatible if their labels differ, their boxes overlap on every non-protected attribute,
+    and each protected attribute can take different values in the two boxes.
+    The candidates of each leaf are found on a list of leaves sorted by the lower bound of one attribute,
+    and only those are checked on all attributes.
+
+    Returns:
+        two arrays of leaf indices (first, second), where the label of first is less than that of second
+    """
+    no_attr = lower.shape[1]
+    shared = np.array([i for i in range(no_attr) if i not in protected_att], dtype=np.int64)
+    protected = np.array(protected_att, dtype=np.int64)
+    if len(shared) > 0:
+        # index the leaves by the shared attribute that is split most often
+        key = shared[np.argmax([len(np.unique(lower[:, i])) for i in shared])]
+        order = np.argsort(lower[:, key], kind="stable")
+        sorted_lower = lower[order, key]
+    else:
+        order = np.arange(len(lower))
+    first, second = list(), list()
+    for a in range(len(lower)):
+        # leaves whose interval of the key attribute starts no later than that of leaf a ends
+        candidates = order[:np.searchsorted(sorted_lower, upper[a, key], side="right")] if len(shared) > 0 else order
+        candidates = candidates[labels[candidates] > labels[a]]
+        if len(candidates) == 0:
+            continue
+        ok = np.all((lower[candidates][:, shared] <= upper[a, shared]) & (lower[a, shared] <= upper[candidates][:, shared]), axis=1)
+        # a protected attribute cannot differ only if it is fixed to the same value in both boxes
+        fixed = (lower[candidates][:, protected] == upper[candidates][:, protected]) & (lower[a, protected] == upper[a, protected]) \
+            & (lower[candidates][:, protected] == lower[a, protected])
+        ok &= ~np.any(fixed, axis=1)
+        candidates = candidates[ok]
+        first.append(np.full(len(candidates), a))
+        second.append(candidates)
+    if not first:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(first), np.concatenate(second)
+
+
+def compatible_leaf_nodes(tree_, data_range, protected_att):
+    """the node ids of the compatible pairs of leaves of a decision tree (see compatible_leaf_pairs)
+
+    Returns:
+        two arrays of node ids (first, second), each pair of which is compatible
+    """
+    lower, upper, labels, leaves = tree_leaf_boxes(tree_, data_range, return_nodes=True)
+    first, second = compatible_leaf_pairs(lower, upper, labels, protected_att)
+    return leaves[first], leaves[second]
+
+
+class BoxSampler:
+    """test cases generation by intersecting the leaf boxes of a decision tree
+
+    An alternative to XORSampler that does not use an SMT solver:
+    each leaf of the decision tree is an axis-aligned box with a class label,
+    so a discriminatory instance of the tree is a pair of points taken from two compatible leaves
+    (see compatible_leaf_pairs) that agree on every non-protected attribute.
+    """
+    def __init__(self, tree_, data_range, protected_att, rng, max_path=100):
+        self.tree_ = tree_
+        self.data_range = data_range
+        self.protected_att = protected_att
+        self.rng = rng
+        self.max_path = max_path
+        self.samples = list()
+
+    def sample(self):
+        """sample at most self.max_path test cases
+
+        The pairs of leaves are chosen uniformly (without replacement) from the compatible pairs,
+        and each test case is drawn uniformly from the intersection of the two boxes.
+        """
+        lower, upper, labels = tree_leaf_boxes(self.tree_, self.data_range)
+        first, second = compatible_leaf_pairs(lower, upper, labels, self.protected_att)
+        if len(first) == 0:
+            return False, []
+
+        chosen = self.rng.choice(len(first), size=min(self.max_path, len(first)), replace=False)
+        first, second = first[chosen], second[chosen]
+        # shared attributes: uniform in the intersection
+        inter_lower = np.maximum(lower[first], lower[second])
+        inter_upper = np.minimum(upper[first], upper[second])
+        inter_lower[:, self.protected_att] = inter_upper[:, self.protected_att] = lower[first][:, self.protected_att]
+        ins1 = self.rng.integers(inter_lower, inter_upper, endpoint=True)
+        ins2 = ins1.copy()
+        # protected attributes: uniform in each box, redrawn until they differ
+        for index in self.protected_att:
+            redraw = np.ones(len(first), dtype=bool)
+            while np.any(redraw):
+                ins1[redraw, index] = self.rng.integers(lower[first[redraw], index], upper[first[redraw], index], endpoint=True)
+                ins2[redraw, index] = self.rng.integers(lower[second[redraw], index], upper[second[redraw], index], endpoint=True)
+                redraw = ins1[:, index] == ins2[:, index]
+
+        # randomize which leaf comes first in a test case
+        swap = self.rng.random(len(first)) < 0.5
+        ins1[swap], ins2[swap] = ins2[swap], ins1[swap]
+        labels1 = np.where(swap, labels[second], labels[first])
+        labels2 = np.where(swap, labels[first], labels[second])
+        for row1, label1, row2, label2 in zip(ins1.tolist(), labels1.tolist(), ins2.tolist(), labels2.tolist()):
+            self.samples.append(row1 + [label1])
+            self.samples.append(row2 + [label2])
+        return True, self.samples
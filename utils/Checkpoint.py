@@ -0,0 +1,27 @@
+import gzip
+import os
+import pickle
+
+
+def save_checkpoint(path, state):
+    """save state (a picklable dict) to path as a gzip-compressed pickle
+
+    The state is written to a temporary file first, so that a run preempted while saving keeps the previous checkpoint.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with gzip.open(path + ".tmp", 'wb', compresslevel=3) as file:
+        pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+
+def load_checkpoint(path):
+    """load the state saved by save_checkpoint, or None if there is no checkpoint at path"""
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rb') as file:
+        return pickle.load(file)
+
+
+def checkpoint_path(label):
+    """the checkpoint of the run with the given label (see Tester.test)"""
+    return os.path.join("Checkpoint", f"{label[0]}-{label[1]}.pkl.gz")
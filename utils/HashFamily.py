@@ -0,0 +1,90 @@
+import numpy as np
+from z3 import BoolRef, Xor
+from z3.z3core import Z3_mk_app, Z3_mk_not
+from z3.z3types import Ast
+
+
+class HashFamily:
+    """random XOR hash functions over the new variables of a tree encoding (see Tree2SMT.get_parm_xor)
+
+    The variables that a hash function may contain are indexed once per formula:
+    the naive version draws each new variable independently, and the other versions draw, for each original attribute
+    that is not protected (nor the class), one of the new variables of the attribute.
+    The hash functions of a round are drawn at once with NumPy, each variable (or attribute) with probability density,
+    so that sparse XORs (a small density) can trade the uniformity of the hash functions for shorter Z3 checks.
+    """
+    def __init__(self, new_var_list, dict_old_to_new, not_equal_list, vbtx_ver="improved", density=0.5):
+        self.density = density
+        if vbtx_ver == "naive":
+            self.variables = list(new_var_list)
+            self.group_size = np.ones(len(self.variables), dtype=np.int64)
+        else:
+            groups = [new_vars for old_var, new_vars in dict_old_to_new.items() if old_var not in not_equal_list and new_vars]
+            self.variables = [new_var for new_vars in groups for new_var in new_vars]
+            self.group_size = np.array([len(new_vars) for new_vars in groups], dtype=np.int64)
+        # the index in self.variables of the first new variable of each group
+        self.group_start = np.cumsum(self.group_size) - self.group_size
+        # the Z3 constants of self.variables and their addresses, made once by z3_terms
+        self.terms = None
+        self.addresses = None
+        self.xor_decl = None
+
+    def draw(self, no_of_xor, rng):
+        """draw no_of_xor hash functions with rng (a numpy.random.Generator)
+
+        Returns:
+            list: a (variable indexes, parity) pair for each hash function, where the XOR contains true if parity is True;
+                the hash functions with neither variables nor true are dropped
+        """
+        shape = (no_of_xor, len(self.group_size))
+        include = rng.random(shape) < self.density
+        choice = self.group_start + (rng.random(shape) * self.group_size).astype(np.int64)
+        parity = rng.random(no_of_xor) < 0.5
+        hashes = list()
+        for i in range(no_of_xor):
+            indexes = choice[i][include[i]]
+            if len(indexes) > 0 or parity[i]:
+                hashes.append((indexes, bool(parity[i])))
+        return hashes
+
+    def to_smt(self, hashes):
+        """the hash functions as SMT-LIB assertions"""
+        return ["(assert (xor%s%s))\n" % ("".join(" " + self.variables[index] for index in indexes.tolist()), " true" if parity else "")
+                for indexes, parity in hashes]
+
+    def z3_terms(self, bool_var):
+        # bool_var maps a name to its Z3 Boolean constant (see IncrementalSolver.bool_var)
+        if self.terms is None:
+            self.terms = [bool_var(var) for var in self.variables]
+            self.addresses = np.array([term.as_ast().value for term in self.terms], dtype=np.uintp) if self.terms else None
+            if self.terms:
+                self.xor_decl = Xor(self.terms[0], self.terms[0]).decl()
+        return self.terms
+
+    def to_z3(self, hashes, bool_var):
+        """the hash functions as Z3 expressions
+
+        Each XOR is made by one call of the C API over the addresses of its variables, which is cheaper than
+        parsing its SMT-LIB assertion, and much cheaper than chaining binary XORs through the Python API.
+        """
+        terms = self.z3_terms(bool_var)
+        constraints = list()
+        for indexes, parity in hashes:
+            if len(indexes) == 0:
+                continue # (xor true) always holds
+            if len(indexes) == 1:
+                xor = terms[indexes[0]]
+            else:
+                addresses = np.ascontiguousarray(self.addresses[indexes])
+                args = (Ast * len(addresses)).from_buffer(addresses)
+                xor = BoolRef(Z3_mk_app(self.xor_decl.ctx_ref(), self.xor_decl.as_func_decl(), len(addresses), args), self.xor_decl.ctx)
+            if parity:
+                # (xor x1 ... xn true) is the negation of (xor x1 ... xn)
+                xor = BoolRef(Z3_mk_not(xor.ctx_ref(), xor.as_ast()), xor.ctx)
+            constraints.append(xor)
+        return constraints
+
+    @staticmethod
+    def size(hashes):
+        # the number of terms (variables and true) of the hash functions
+        return sum(len(indexes) + parity for indexes, parity in hashes)
@@ -0,0 +1,82 @@
+from z3 import Solver, SolverFor, Bool, parse_smt2_string, sat
+
+
+# the value of the timeout parameter of Z3 that means no timeout
+NO_TIMEOUT = 4294967295
+
+
+class IncrementalSolver:
+    """Z3 solver that keeps a base formula asserted across sampling rounds
+
+    The base formula (declarations, decision tree, fairness constraints, and so on) is parsed and asserted once.
+    The constraints of each round (e.g., XOR and blocking clauses) are added inside a push/pop scope,
+    so that they are removed after the round while the solver keeps the state learned from the base formula.
+    """
+    def __init__(self, declare_str, base_str="", assertions=None, variables=None, logic=None):
+        self.declare_str = declare_str
+        self.solver = Solver() if logic is None else SolverFor(logic)
+        self.solver.from_string(declare_str + base_str)
+        if assertions is not None:
+            self.solver.add(assertions)
+        self.timeout = None
+        self.result = None # the result of the last check: sat, unsat or unknown (e.g., timeout)
+        self.bool_vars = dict()
+        self.consts = dict() if variables is None else dict(variables)
+
+    def bool_var(self, name):
+        if name not in self.bool_vars:
+            self.bool_vars[name] = Bool(name)
+        return self.bool_vars[name]
+
+    def get_consts(self, names):
+        # look up the declared constants (with their sorts) of the given names
+        missing = [name for name in names if name not in self.consts]
+        if missing:
+            assertions = parse_smt2_string(self.declare_str + "".join(f"(assert (= {name} {name}))\n" for name in missing))
+            for name, item in zip(missing, assertions):
+                self.consts[name] = item.arg(0)
+        return [self.consts[name] for name in names]
+
+    def add(self, *constraints):
+        self.solver.add(*constraints)
+
+    def add_string(self, smt_str):
+        self.solver.from_string(smt_str)
+
+    def push(self):
+        self.solver.push()
+
+    def pop(self):
+        self.solver.pop()
+
+    def set_timeout(self, timeout):
+        # timeout in seconds (None: no timeout), only passed to Z3 when it changes
+        if timeout != self.timeout:
+            self.solver.set("timeout", NO_TIMEOUT if timeout is None else max(1, int(timeout * 1000)))
+            self.timeout = timeout
+
+    def check(self, *constraints, smt_str="", timeout=None):
+        """check the base formula (and the constraints added so far) together with the given constraints
+
+        Args:
+            constraints: Z3 expressions to be checked in this round only
+            smt_str (str): SMT-LIB assertions to be checked in this round only,
+                which is cheaper than building large expressions (e.g., dense XORs) through the Python API
+            timeout (float): the time limit of this check in seconds (None: no limit)
+
+        Returns:
+            the model if it is satisfiable, otherwise None (see self.result to tell unsat from timeout)
+        """
+        self.set_timeout(timeout)
+        if not constraints and not smt_str:
+            self.result = self.solver.check()
+            return self.solver.model() if self.result == sat else None
+        self.solver.push()
+        try:
+            self.solver.add(*constraints)
+            if smt_str:
+                self.solver.from_string(smt_str)
+            self.result = self.solver.check()
+            return self.solver.model() if self.result == sat else None
+        finally:
+            self.solver.pop()
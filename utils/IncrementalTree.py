@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class TreeArrays:
+    """the arrays of a decision tree, in the layout of DecisionTreeClassifier.tree_
+
+    value[node, 0, k] is the weight of the k-th class of the whole tree (not of a subtree) at the node.
+    """
+    def __init__(self, feature, threshold, children_left, children_right, value):
+        self.feature = feature
+        self.threshold = threshold
+        self.children_left = children_left
+        self.children_right = children_right
+        self.value = value
+
+    @property
+    def node_count(self):
+        return len(self.feature)
+
+    @classmethod
+    def from_tree(cls, tree_, classes, all_classes):
+        # the columns of value are reordered from classes (of the fitted tree) to all_classes
+        value = np.zeros((tree_.node_count, 1, len(all_classes)))
+        value[:, 0, np.searchsorted(all_classes, classes)] = tree_.value[:, 0, :]
+        return cls(tree_.feature.copy(), tree_.threshold.copy(), tree_.children_left.copy(), tree_.children_right.copy(), value)
+
+    def apply(self, X):
+        """the index of the leaf that each row of X reaches"""
+        nodes = np.zeros(len(X), dtype=np.int64)
+        rows = np.arange(len(X))
+        active = self.feature[nodes] >= 0
+        while np.any(active):
+            rows, nodes_active = rows[active], nodes[rows[active]]
+            go_left = X[rows, self.feature[nodes_active]] <= self.threshold[nodes_active]
+            nodes[rows] = np.where(go_left, self.children_left[nodes_active], self.children_right[nodes_active])
+            active = self.feature[nodes[rows]] >= 0
+        return nodes
+
+    def graft(self, leaf, subtree):
+        """replace the leaf with the root of subtree (a TreeArrays), appending the other nodes of subtree"""
+        base = self.node_count - 1
+        # node i > 0 of subtree becomes node base + i, and its root becomes the leaf
+        index = np.arange(subtree.node_count) + base
+        index[0] = leaf
+
+        def remap(children):
+            return np.where(children == -1, -1, index[children])
+        self.feature = np.concatenate((self.feature, subtree.feature[1:]))
+        self.threshold = np.concatenate((self.threshold, subtree.threshold[1:]))
+        self.children_left = np.concatenate((self.children_left, remap(subtree.children_left)[1:]))
+        self.children_right = np.concatenate((self.children_right, remap(subtree.children_right)[1:]))
+        self.value = np.concatenate((self.value, subtree.value[1:]))
+        self.feature[leaf] = subtree.feature[0]
+        self.threshold[leaf] = subtree.threshold[0]
+        self.children_left[leaf] = remap(subtree.children_left[:1])[0]
+        self.children_right[leaf] = remap(subtree.children_right[:1])[0]
+        self.value[leaf] = subtree.value[0]
+
+
+class IncrementalTree:
+    """decision tree that is updated by refitting only the subtrees of the leaves that receive new training data
+
+    Since a leaf of a decision tree fitted without depth limit contains training data of one label,
+    growing a subtree under each leaf that gets new data of another label keeps the tree consistent with all the training data.
+    The tree is fitted from scratch by fit, e.g., after a restart, and is updated by update afterwards.
+
+    The subtrees are fitted on the data of a leaf only, so the tree generalizes worse than a tree fitted on all the data
+    as more data is added; the tree is refitted from scratch once the data grows by more than max_growth since the last full fit.
+
+    Args:
+        make_classifier: a function that returns an unfitted DecisionTreeClassifier
+        max_growth (float): the ratio of the data added since the last full fit that triggers a full refit
+    """
+    def __init__(self, make_classifier, max_growth=0.1):
+        self.make_classifier = make_classifier
+        self.max_growth = max_growth
+        self.no_full_fit = 0 # the number of training data of the last full fit
+        self.tree_ = None
+        self.classes_ = None
+        self.no_refit_leaf = 0
+
+    def fit(self, X, Y):
+        clf = self.make_classifier().fit(X, Y)
+        self.no_full_fit = len(X)
+        self.classes_ = clf.classes_
+        self.tree_ = TreeArrays.from_tree(clf.tree_, clf.classes_, clf.classes_)
+        return self
+
+    def update(self, X, Y, no_old):
+        """update the tree with the training data X[no_old:] and Y[no_old:] added after the last fit or update
+
+        Returns:
+            bool: False if the tree needs a full refit, i.e., the data has grown by more than max_growth,
+                or the new data has a label that the tree has never seen
+        """
+        if len(X) > (1 + self.max_growth) * self.no_full_fit or not np.all(np.isin(Y[no_old:], self.classes_)):
+            return False
+        leaves = self.tree_.apply(X)
+        labels = self.classes_[np.argmax(self.tree_.value[leaves, 0], axis=1)]
+        # the leaves that misclassify some of the new data
+        for leaf in np.unique(leaves[no_old:][labels[no_old:] != Y[no_old:]]):
+            rows = leaves == leaf
+            clf = self.make_classifier().fit(X[rows], Y[rows])
+            self.tree_.graft(leaf, TreeArrays.from_tree(clf.tree_, clf.classes_, self.classes_))
+            self.no_refit_leaf += 1
+        return True
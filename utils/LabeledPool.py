@@ -0,0 +1,106 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+import numpy as np
+
+
+class LabeledPool:
+    """inputs labeled by a black box model, saved to a file and shared by the testers (and processes) of the same model
+
+    Each row holds the attributes of an input and its label as int64, appended to path and read memory-mapped.
+    A draw of num rows subsamples them from the pool, which is first topped up to scale * num rows if it is smaller,
+    so that the draws (e.g., of the repeats and restarts of a configuration) differ while the model labels each input once.
+    The processes sharing the pool lock path + ".lock": shared to read the size of the pool, exclusive to top it up.
+    What produced the rows (source, e.g., the model file and the data range, and no_column) is saved to path + ".json",
+    and a pool saved from another source is emptied when it is opened, so that its rows are labeled again.
+    """
+    def __init__(self, path, no_column, scale=4, source=None):
+        self.path = path
+        self.no_column = no_column # the number of attributes plus the label
+        self.scale = scale
+        self.source = dict(source or {}, no_column=no_column)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock_file = open(path + ".lock", 'a')
+        self.rows = None # the memory-mapped rows, as many as the pool had when they were mapped
+        self.no_labeled = 0 # the number of rows labeled by this process to top up the pool
+        self.rebuilt = self.check_source()
+
+    def check_source(self):
+        """empty the pool if it was saved from another source than self.source
+
+        Returns:
+            bool: whether the pool has been emptied
+        """
+        source_path = self.path + ".json"
+        with self.lock(fcntl.LOCK_EX):
+            saved = None
+            if os.path.exists(source_path):
+                with open(source_path) as file:
+                    saved = json.load(file)
+            if saved == self.source and os.path.exists(self.path):
+                return False
+            # a pool saved before its source was recorded is not trusted either, unless it is empty
+            stale = os.path.exists(self.path) and (saved is not None or os.path.getsize(self.path) > 0)
+            # a new empty file replaces the pool, so that the rows mapped by another process stay valid
+            open(self.path + ".tmp", 'wb').close()
+            os.replace(self.path + ".tmp", self.path)
+            with open(source_path + ".tmp", 'w') as file:
+                json.dump(self.source, file)
+            os.replace(source_path + ".tmp", source_path)
+            return stale
+
+    @contextmanager
+    def lock(self, operation):
+        fcntl.flock(self.lock_file, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def size(self):
+        # a row being appended by another process (or left half-written by a killed one) is not counted
+        return os.path.getsize(self.path) // (8 * self.no_column)
+
+    def map_rows(self, size):
+        # the file only grows, so the rows are mapped again only when the pool has grown
+        if self.rows is None or len(self.rows) != size:
+            self.rows = np.memmap(self.path, dtype=np.int64, mode='r', shape=(size, self.no_column))
+        return self.rows
+
+    def top_up(self, size, label_func):
+        """append size - len(self) rows labeled by label_func (a function from a number of rows to an array of labeled rows)"""
+        with self.lock(fcntl.LOCK_EX):
+            # another process may have topped up the pool while this one was waiting for the lock
+            no_row = self.size()
+            if no_row >= size:
+                return no_row
+            rows = np.ascontiguousarray(label_func(size - no_row), dtype=np.int64).reshape(-1, self.no_column)
+            with open(self.path, 'r+b') as file:
+                # drop a half-written row, if any, so that the new rows are aligned
+                file.truncate(8 * self.no_column * no_row)
+                file.seek(0, os.SEEK_END)
+                file.write(rows.tobytes())
+            self.no_labeled += len(rows)
+            return no_row + len(rows)
+
+    def draw(self, num, rng, label_func):
+        """draw num distinct rows from the pool with rng (a numpy.random.Generator), topping it up with label_func if needed
+
+        Returns:
+            numpy.ndarray: the rows, whose last column is the label
+        """
+        with self.lock(fcntl.LOCK_SH):
+            size = self.size()
+        if size < self.scale * num:
+            size = self.top_up(self.scale * num, label_func)
+        rows = self.map_rows(size)
+        # sorted indexes read the file in order
+        return np.array(rows[np.sort(rng.choice(size, num, replace=False))])
+
+    def __len__(self):
+        return self.size()
+
+    def close(self):
+        self.rows = None
+        self.lock_file.close()
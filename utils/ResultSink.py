@@ -0,0 +1,137 @@
+import csv
+import glob
+import os
+import time
+import numpy as np
+
+
+class CSVSink:
+    """append rows to a CSV file as they are produced"""
+    def __init__(self, path, append=False, position=None):
+        self.path = path
+        if position is not None:
+            # drop the rows written after the position (e.g., after the checkpoint a run resumes from)
+            os.truncate(path, position)
+            append = True
+        self.file = open(path, 'a' if append else 'w', newline='')
+        self.writer = csv.writer(self.file)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+        # rows written so far survive a crash of the run
+        self.file.flush()
+
+    def position(self):
+        """the size of the file written so far, to be passed back to the constructor when resuming"""
+        return self.file.tell()
+
+    def read(self):
+        """the rows written so far, as a list of lists"""
+        self.file.flush()
+        if os.path.getsize(self.path) == 0:
+            return list()
+        return np.loadtxt(self.path, delimiter=",", dtype=np.int64, ndmin=2).tolist()
+
+    def close(self):
+        self.file.close()
+
+
+class NpySink:
+    """append rows to a directory of .npy chunks
+
+    Rows are buffered and saved as one integer array per chunk_rows rows (e.g., 000000.npy, 000001.npy, ...),
+    which can be read back with memory mapping by load_npy_chunks.
+    The buffer is also saved as a shorter chunk by a write flush_interval seconds after the last chunk (None: never),
+    so a crash of the run loses the rows of the last flush_interval seconds at most, instead of up to chunk_rows rows.
+    """
+    def __init__(self, path, chunk_rows=10000, flush_interval=5, append=False, position=None):
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        os.makedirs(path, exist_ok=True)
+        chunks = sorted(glob.glob(os.path.join(path, "*.npy")))
+        if not append or position is not None:
+            # drop all the chunks, or those written after the position
+            for chunk in chunks[position or 0:]:
+                os.remove(chunk)
+            chunks = chunks[:position or 0]
+        self.no_chunk = len(chunks)
+        self.buffer = list()
+        self.last_flush = time.time()
+
+    def write(self, rows):
+        self.buffer += rows
+        if len(self.buffer) >= self.chunk_rows or \
+                (self.flush_interval is not None and time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.time()
+        if not self.buffer:
+            return
+        # write to a temporary file first, so that a reader never sees a partial chunk
+        chunk = os.path.join(self.path, f"{self.no_chunk:06d}.npy")
+        with open(chunk + ".tmp", 'wb') as npyfile:
+            np.save(npyfile, np.asarray(self.buffer, dtype=np.int64))
+        os.replace(chunk + ".tmp", chunk)
+        self.no_chunk += 1
+        self.buffer = list()
+
+    def position(self):
+        """the number of chunks written so far (after saving the buffered rows), to be passed back to the constructor when resuming"""
+        self.flush()
+        return self.no_chunk
+
+    def read(self):
+        """the rows written so far, as a list of lists"""
+        self.flush()
+        return [row for chunk in load_npy_chunks(self.path) for row in chunk.tolist()]
+
+    def close(self):
+        self.flush()
+
+
+def load_npy_chunks(path, mmap_mode="r"):
+    """load the chunks written by NpySink (memory-mapped by default), in the order they were written"""
+    return [np.load(chunk, mmap_mode=mmap_mode) for chunk in sorted(glob.glob(os.path.join(path, "*.npy")))]
+
+
+class MultiSink:
+    """write the same rows to several sinks"""
+    def __init__(self, sinks):
+        self.sinks = sinks
+
+    def write(self, rows):
+        if rows:
+            for sink in self.sinks:
+                sink.write(rows)
+
+    def position(self):
+        return [sink.position() for sink in self.sinks]
+
+    def read(self):
+        # all the sinks hold the same rows
+        return self.sinks[0].read() if self.sinks else list()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def open_sinks(folder, name, output_format=("csv",), append=False, position=None):
+    """open the sinks of the given formats ("csv" and/or "npy") for folder/name
+
+    The CSV file is saved to folder/name.csv, and the .npy chunks are saved to the directory folder/name-npy.
+    If position (as returned by MultiSink.position) is given, the sinks continue from that position.
+    """
+    sinks = list()
+    for i, fmt in enumerate(output_format):
+        sink_position = None if position is None else position[i]
+        if fmt == "csv":
+            sinks.append(CSVSink(os.path.join(folder, f"{name}.csv"), append=append, position=sink_position))
+        elif fmt == "npy":
+            sinks.append(NpySink(os.path.join(folder, f"{name}-npy"), append=append, position=sink_position))
+        else:
+            print(f"No such output format: {fmt}")
+            exit()
+    return MultiSink(sinks)
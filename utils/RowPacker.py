@@ -0,0 +1,53 @@
+import numpy as np
+
+
+class RowPacker:
+    """pack integer rows into fixed-width integer keys
+
+    Each attribute takes as many bits as its range in data_range needs,
+    and a row is packed from the offsets of its values from the lower bounds.
+    The packed bits are computed in 63-bit words with NumPy, and then joined into one Python integer per row.
+    A row outside of data_range is keyed by its bytes instead.
+    """
+    word_bits = 63
+
+    def __init__(self, data_range):
+        data_range = np.asarray(data_range, dtype=np.int64)
+        self.lower = data_range[:, 0]
+        self.upper = data_range[:, 1]
+        widths = [max(1, int(width).bit_length()) for width in self.upper - self.lower]
+        # assign the attributes to words in order, and compute the shift of each attribute in its word
+        self.word = np.zeros(len(widths), dtype=np.int64)
+        self.shift = np.zeros(len(widths), dtype=np.int64)
+        no_word, used = 0, 0
+        for i, width in enumerate(widths):
+            if used + width > self.word_bits:
+                no_word, used = no_word + 1, 0
+            self.word[i], self.shift[i] = no_word, used
+            used += width
+        self.no_word = no_word + 1
+        self.no_bits = self.word_bits * no_word + used
+
+    def pack(self, rows):
+        """pack the given rows (a 2D array-like of integers) into a list of keys"""
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1, len(self.lower))
+        inside = np.all((rows >= self.lower) & (rows <= self.upper), axis=1)
+        parts = (np.where(inside[:, None], rows - self.lower, 0)) << self.shift
+        keys = [0] * len(rows)
+        for no_word in range(self.no_word):
+            words = parts[:, self.word == no_word].sum(axis=1).tolist()
+            shift = self.word_bits * no_word
+            keys = [key | (word << shift) for key, word in zip(keys, words)]
+        for i in np.flatnonzero(~inside).tolist():
+            keys[i] = rows[i].tobytes()
+        return keys
+
+    def pack_pairs(self, rows):
+        """pack the consecutive pairs of the given rows (row 0 and 1, row 2 and 3, ...) into a list of keys
+
+        The two rows of a pair are unordered, i.e., the key of (a, b) is that of (b, a):
+        the keys of the two rows are sorted, those of rows outside of data_range (bytes) after the others (int).
+        """
+        keys = self.pack(rows)
+        return [(key0, key1) if (isinstance(key0, bytes), key0) <= (isinstance(key1, bytes), key1) else (key1, key0)
+                for key0, key1 in zip(keys[0::2], keys[1::2])]
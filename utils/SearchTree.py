@@ -1,5 +1,10 @@
+import hashlib
+import math
 import numpy as np
 import copy
+from z3 import Int, Bool, BoolRef, BoolVal, IntVal, BitVec, BitVecVal, And, Or, Not, Implies, is_bv
+from z3.z3core import Z3_mk_and, Z3_mk_le, Z3_mk_gt, Z3_mk_bvule, Z3_mk_bvugt
+from z3.z3types import Ast
 
 
 class LogicalFormula:
@@ -23,8 +28,54 @@ class LogicalFormula:
         return self.sign + ' ' + str(self.num)
 
 
+def mk_compare(signal, var, bound):
+    # (signal var bound) through the C API, which skips the argument coercion of the z3py operators
+    if is_bv(var):
+        mk = Z3_mk_bvule if signal == "<=" else Z3_mk_bvugt
+    else:
+        mk = Z3_mk_le if signal == "<=" else Z3_mk_gt
+    return BoolRef(mk(var.ctx_ref(), var.as_ast(), bound.as_ast()), var.ctx)
+
+
+def mk_and2(a, b):
+    args = (Ast * 2)(a.as_ast(), b.as_ast())
+    return BoolRef(Z3_mk_and(a.ctx_ref(), 2, args), a.ctx)
+
+
+def tree_fingerprint(tree_):
+    # digest of the structure, thresholds and leaf labels of a decision tree, which determine its SMT formula
+    digest = hashlib.blake2b(digest_size=16)
+    for array in (tree_.feature, tree_.threshold, tree_.children_left, tree_.children_right, np.argmax(tree_.value[:, 0], axis=1)):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+class TreeFormula:
+    """SMT formula of a decision tree as Z3 expressions
+
+    Attributes:
+        declare_str (str): SMT-LIB declarations of all variables, so that a solver can also parse constraints over them
+        variables (dict): variable name -> Z3 constant
+        assertions (list): Z3 expressions of the tree, fairness and new-variable constraints
+    """
+    def __init__(self, declare_str, variables, assertions):
+        self.declare_str = declare_str
+        self.variables = variables
+        self.assertions = assertions
+
+
 class Tree2SMT:
-    def __init__(self, feature_names=[], class_name="", protected_att=[8], no_of_tree=2, vbtx_ver="improved"):
+    # bit-width of the class variable in the bit-vector encoding, i.e., up to 256 classes
+    class_width = 8
+
+    def __init__(self, feature_names=[], class_name="", protected_att=[8], no_of_tree=2, vbtx_ver="improved", encoding="int", data_range=None):
+        """
+        Args:
+            encoding (str): "int" declares each attribute as an integer,
+                and "bv" declares it as a bit-vector of the minimum width for its range in data_range
+            data_range (list): the range of each attribute, e.g., [[1, 2], [3, 4]];
+                if given, each attribute is constrained to its range (required by "bv")
+        """
         self.declare_smt = ""
         self.fairness_constraints = ""
         self.check_smt = "(check-sat)\n(get-model)"
@@ -33,6 +84,18 @@ class Tree2SMT:
         self.protected_att = protected_att
         self.no_of_tree = no_of_tree
         self.vbtx_ver = vbtx_ver
+        self.encoding = encoding
+        self.data_range = data_range
+
+        # In the bit-vector encoding, a variable holds the offset of the value from the lower bound of its range
+        self.offsets = dict()
+        self.bv_width = dict()
+        if encoding == "bv":
+            for feature, (min_, max_) in zip(feature_names, data_range):
+                self.offsets[feature] = int(min_)
+                self.bv_width[feature] = max(1, (int(max_) - int(min_)).bit_length())
+            self.offsets[class_name] = 0
+            self.bv_width[class_name] = self.class_width
 
         # Prepare for XORSampler
         self.not_equal_list = list()
@@ -42,17 +105,19 @@ class Tree2SMT:
                 self.not_equal_list.append(item + index)
         self.no_of_new_var = 0
         self.new_var_list = list()
+        self.new_var_defs = list()
         self.old_var_list = feature_names + [class_name]
         self.dict_old_to_new = dict()
         self.smt2_content = {"old": "", "tree": "", "fairness": "", "new": "", "xor": [], "blocking_loop1": [], "blocking_loop2": "", "check": self.check_smt}
-        self.param_xor = {"new_var_list": self.new_var_list, "old_var_list": self.old_var_list, "dict_old_to_new": self.dict_old_to_new, "smt2_content": self.smt2_content, "not_equal_list": self.not_equal_list}
+        self.param_xor = {"new_var_list": self.new_var_list, "old_var_list": self.old_var_list, "dict_old_to_new": self.dict_old_to_new, "smt2_content": self.smt2_content, "not_equal_list": self.not_equal_list,
+                          "encoding": self.encoding, "offsets": self.offsets}
 
         # Create declare part in smt file
         for i in range(no_of_tree):
             self.declare_smt += f";{i}th attribute\n"
-            for feature in self.feature_names:
-                self.declare_smt += f"(declare-fun {feature}{i} () Int)\n"
-            self.declare_smt += f"(declare-fun {self.class_name}{i} () Int)\n"
+            for feature in self.old_var_list:
+                sort = f"(_ BitVec {self.bv_width[feature]})" if encoding == "bv" else "Int"
+                self.declare_smt += f"(declare-fun {feature}{i} () {sort})\n"
         self.smt2_content["old"] = self.declare_smt
 
         # Create fairness constraints in smt file
@@ -68,8 +133,48 @@ class Tree2SMT:
         for i in range(self.no_of_tree):
             temp += f" {self.class_name}{i}"
         self.fairness_constraints += f"(assert (not(= {temp})))\n"
+
+        # Create domain constraints in smt file
+        if data_range is not None:
+            for feature, (min_, max_) in zip(self.feature_names, data_range):
+                for i in range(self.no_of_tree):
+                    if encoding == "bv":
+                        if int(max_) - int(min_) < 2 ** self.bv_width[feature] - 1:
+                            self.fairness_constraints += f"(assert {self.smt_atom('<=', feature + str(i), max_)})\n"
+                    else:
+                        self.fairness_constraints += f"(assert (and (<= {min_} {feature}{i}) (<= {feature}{i} {max_})))\n"
         self.smt2_content["fairness"] = "\n" + self.fairness_constraints
 
+    def smt_atom(self, signal, var_name, number):
+        """the SMT-LIB atom (signal var_name number), where var_name is an attribute name followed by the index of a tree copy"""
+        if self.encoding != "bv":
+            return f"({signal} {var_name} {number})"
+        width = self.bv_width[var_name[:-1]]
+        code = int(number) - self.offsets[var_name[:-1]]
+        if signal == "=":
+            return f"(= {var_name} (_ bv{code} {width}))"
+        # thresholds outside of the range make the atom constant
+        if code < 0:
+            return "false" if signal == "<=" else "true"
+        if code >= 2 ** width - 1:
+            return "true" if signal == "<=" else "false"
+        return f"({'bvule' if signal == '<=' else 'bvugt'} {var_name} (_ bv{code} {width}))"
+
+    def z3_atom(self, signal, var, var_name, number):
+        # the same atom as smt_atom, as a Z3 expression over var
+        if self.encoding != "bv":
+            bound = IntVal(int(number))
+            return var == bound if signal == "=" else mk_compare(signal, var, bound)
+        width = self.bv_width[var_name[:-1]]
+        code = int(number) - self.offsets[var_name[:-1]]
+        if signal == "=":
+            return var == BitVecVal(code, width)
+        if code < 0:
+            return BoolVal(signal == ">")
+        if code >= 2 ** width - 1:
+            return BoolVal(signal == "<=")
+        return mk_compare(signal, var, BitVecVal(code, width))
+
     def record_node_basic(self, signal, var_name, number, new_var_log):
             if var_name not in self.dict_old_to_new:
                 self.dict_old_to_new[var_name] = list()
@@ -88,8 +193,9 @@ class Tree2SMT:
                 self.new_var_list.append(new_var)
                 self.dict_old_to_new[var_name].append(new_var)
                 new_var_log[new_var] = new_log
+                self.new_var_defs.append((new_var, signal, var_name, number))
                 self.smt2_content['new'] += f"(declare-fun {new_var} () Bool)\n"
-                self.smt2_content['new'] += f"(assert (= {new_var} ({signal} {var_name} {number})))\n"
+                self.smt2_content['new'] += f"(assert (= {new_var} {self.smt_atom(signal, var_name, number)}))\n"
 
     def record_node(self, signal, var_name, number, new_var_log):
         if var_name in self.not_equal_list:
@@ -114,12 +220,14 @@ class Tree2SMT:
                 self.new_var_list.append(new_var)
                 self.dict_old_to_new[var_name].append(new_var)
                 new_var_log[new_var] = new_log
+                self.new_var_defs.append((new_var, signal, var_name + '0', number))
                 self.smt2_content['new'] += f"(declare-fun {new_var} () Bool)\n"
-                self.smt2_content['new'] += f"(assert (= {new_var} ({signal} {var_name+'0'} {number})))\n"
+                self.smt2_content['new'] += f"(assert (= {new_var} {self.smt_atom(signal, var_name + '0', number)}))\n"
 
     def reset_smt(self):
         self.no_of_new_var = 0
         self.new_var_list.clear()
+        self.new_var_defs.clear()
         self.dict_old_to_new.clear()
         self.smt2_content["tree"] = ""
         self.smt2_content["new"] = ""
@@ -127,26 +235,55 @@ class Tree2SMT:
     def get_parm_xor(self):
         return copy.deepcopy(self.param_xor)
 
-    def dt_to_smt(self, DT):
-        # traverse the given decision tree (DT), to construct an SMT formula
+    def leaf_partners(self, leaf_pairs):
+        # the leaves that each leaf of the compatible pairs can be paired with
+        partners = dict()
+        for a, b in zip(leaf_pairs[0].tolist(), leaf_pairs[1].tolist()):
+            partners.setdefault(a, []).append(b)
+            partners.setdefault(b, []).append(a)
+        return partners
+
+    def leaf_pairs_smt(self, leaf_pairs):
+        """the SMT-LIB constraints that the copies 0 and 1 of the tree fall into the two leaves of one of leaf_pairs
+
+        The leaf indicator leaf<node>_<copy> is declared and defined by the tree constraints (see dt_to_smt).
+        As clauses: copy 0 falls into a leaf of the pairs, and each such leaf implies that copy 1 falls into one of its partners.
+        """
+        partners = self.leaf_partners(leaf_pairs)
+        smt_str = f"(assert (or{''.join(f' leaf{a}_0' for a in partners)}))\n"
+        for a, others in partners.items():
+            smt_str += f"(assert (=> leaf{a}_0 (or{''.join(f' leaf{b}_1' for b in others)})))\n"
+        return smt_str
+
+    def dt_to_smt(self, DT, leaf_pairs=None):
+        """traverse the given decision tree (DT), to construct an SMT formula
+
+        Args:
+            leaf_pairs (tuple): two arrays of node ids, the compatible pairs of leaves (see BoxSampler.compatible_leaf_nodes);
+                if given, only the leaves in these pairs are encoded, each by an indicator variable,
+                and the two copies of the tree are constrained to one of the pairs
+        """
         tree_ = DT.tree_
         feature = tree_.feature
         all_paths = []
+        leaf_nodes = []
 
         def recurse(node, path):
             if feature[node] != -2: # find a node
                 index = feature[node]
                 threshold = tree_.threshold[node]
                 attr_name = self.feature_names[index]
+                # x <= threshold for an integer x is x <= floor(threshold), also for negative thresholds (see tree_leaf_boxes)
                 if tree_.children_left[node] != -1:
-                    path.append(["<=", attr_name, str(int(threshold))])
+                    path.append(["<=", attr_name, str(math.floor(threshold))])
                     recurse(tree_.children_left[node], path)
                 if tree_.children_right[node] != -1:
-                    path.append([">", attr_name, str(int(threshold))])
+                    path.append([">", attr_name, str(math.floor(threshold))])
                     recurse(tree_.children_right[node], path)
             else: # find leaf
                 pre_res = np.argmax(tree_.value[node][0])
                 all_paths.append(path + [["=", self.class_name, str(pre_res)]])
+                leaf_nodes.append(node)
             if len(path) != 0:
                 path.pop()
 
@@ -155,31 +292,124 @@ class Tree2SMT:
         res = ""
         res += self.declare_smt
         dt_constraints = ""
+        paired = None if leaf_pairs is None else set(leaf_pairs[0].tolist()) | set(leaf_pairs[1].tolist())
         for i in range(self.no_of_tree):
             dt_constraints += f";-------------{i}th-number tree constraint-------------\n"
-            for path in all_paths:
+            for node, path in zip(leaf_nodes, all_paths):
                 path_str = ""
                 for items in path[:-1]:
-                    temp = copy.deepcopy(items)
-                    temp[1] = temp[1] + str(i)
-                    path_str += " (" + " ".join(temp) + ")"
-                temp = copy.deepcopy(path[-1])
-                temp[1] = temp[1] + str(i)
-                res_str = " ".join(temp)
-                dt_constraints += f"(assert (=> (and{path_str}) ({res_str})))\n"
+                    path_str += " " + self.smt_atom(items[0], items[1] + str(i), items[2])
+                res_str = self.smt_atom(path[-1][0], path[-1][1] + str(i), path[-1][2])
+                if paired is None:
+                    dt_constraints += f"(assert (=> (and{path_str}) {res_str}))\n"
+                elif node in paired:
+                    dt_constraints += f"(declare-fun leaf{node}_{i} () Bool)\n"
+                    dt_constraints += f"(assert (= leaf{node}_{i} (and{path_str})))\n"
+                    dt_constraints += f"(assert (=> leaf{node}_{i} {res_str}))\n"
+        if paired is not None:
+            dt_constraints += self.leaf_pairs_smt(leaf_pairs)
         self.smt2_content["tree"] += "\n" + dt_constraints
         res += "\n" + dt_constraints
         res += "\n" + self.fairness_constraints
         res += "\n" + self.check_smt
 
+        # the edges of all the paths, in order (record_edges skips the conditions recorded before)
+        self.record_edges([items for path in all_paths for items in path[:-1]])
+        return res
+
+    def record_edges(self, edges):
+        # create new variables for XORSampler from the branching conditions of the decision tree
         new_var_list = dict()
         if self.vbtx_ver == "naive":
             for index in ["0", "1"]:
-                for path in all_paths:
-                    for items in path[:-1]:
-                        self.record_node_basic(items[0], items[1]+index, items[2], new_var_list)
+                for items in edges:
+                    self.record_node_basic(items[0], items[1]+index, items[2], new_var_list)
         else:
-            for path in all_paths:
-                for items in path[:-1]:
-                    self.record_node(items[0], items[1], items[2], new_var_list)
-        return res
\ No newline at end of file
+            for items in edges:
+                self.record_node(items[0], items[1], items[2], new_var_list)
+
+    def dt_to_formula(self, DT, leaf_pairs=None):
+        """construct the SMT formula of the given decision tree (DT) directly as Z3 expressions
+
+        Unlike dt_to_smt, no SMT-LIB text is built for the tree: the arrays of DT.tree_ are walked iteratively,
+        and each node is reached by extending the conjunction of its parent, so paths share their common prefixes.
+        leaf_pairs restricts the formula to the compatible pairs of leaves as in dt_to_smt.
+
+        Returns:
+            TreeFormula: the formula, which can be asserted to any number of solvers
+        """
+        tree_ = DT.tree_
+        feature = tree_.feature.tolist()
+        threshold = tree_.threshold.tolist()
+        children_left = tree_.children_left.tolist()
+        children_right = tree_.children_right.tolist()
+        labels = np.argmax(tree_.value[:, 0], axis=1).tolist()
+        copies = [str(i) for i in range(self.no_of_tree)]
+        if self.encoding == "bv":
+            variables = {name + i: BitVec(name + i, self.bv_width[name]) for i in copies for name in self.old_var_list}
+        else:
+            variables = {name + i: Int(name + i) for i in copies for name in self.old_var_list}
+
+        assertions = list()
+        edges = list()
+        paired = None if leaf_pairs is None else set(leaf_pairs[0].tolist()) | set(leaf_pairs[1].tolist())
+        # each stack item: node id and the conditions reaching the node in each copy of the tree (None for root)
+        stack = [(0, [None] * self.no_of_tree)]
+        while stack:
+            node, reach = stack.pop()
+            if feature[node] != -2:
+                attr_name = self.feature_names[feature[node]]
+                number = math.floor(threshold[node])
+                branches = list()
+                if children_left[node] != -1:
+                    edges.append(("<=", attr_name, str(number)))
+                    branches.append((children_left[node], "<="))
+                if children_right[node] != -1:
+                    edges.append((">", attr_name, str(number)))
+                    branches.append((children_right[node], ">"))
+                # push the right child first so that the left subtree is visited first, as in dt_to_smt
+                for child, signal in reversed(branches):
+                    conds = [self.z3_atom(signal, variables[attr_name + i], attr_name + i, number) for i in copies]
+                    stack.append((child, [cond if r is None else mk_and2(r, cond) for r, cond in zip(reach, conds)]))
+            elif paired is None:
+                for r, i in zip(reach, copies):
+                    label = self.z3_atom("=", variables[self.class_name + i], self.class_name + i, labels[node])
+                    assertions.append(label if r is None else Implies(r, label))
+            elif node in paired:
+                for r, i in zip(reach, copies):
+                    label = self.z3_atom("=", variables[self.class_name + i], self.class_name + i, labels[node])
+                    variables[f"leaf{node}_{i}"] = indicator = Bool(f"leaf{node}_{i}")
+                    assertions.append(indicator == (BoolVal(True) if r is None else r))
+                    assertions.append(Implies(indicator, label))
+        if paired is not None:
+            # the same clauses as leaf_pairs_smt
+            partners = self.leaf_partners(leaf_pairs)
+            assertions.append(Or([variables[f"leaf{a}_0"] for a in partners]))
+            for a, others in partners.items():
+                assertions.append(Implies(variables[f"leaf{a}_0"], Or([variables[f"leaf{b}_1"] for b in others])))
+
+        # fairness constraints
+        for index, name in enumerate(self.old_var_list):
+            same = And([variables[name + copies[0]] == variables[name + i] for i in copies[1:]])
+            if index in self.protected_att or name == self.class_name:
+                assertions.append(Not(same))
+            else:
+                assertions.append(same)
+        # domain constraints
+        if self.data_range is not None:
+            for name, (min_, max_) in zip(self.feature_names, self.data_range):
+                for i in copies:
+                    if self.encoding == "bv":
+                        assertions.append(self.z3_atom("<=", variables[name + i], name + i, max_))
+                    else:
+                        assertions.append(And(int(min_) <= variables[name + i], variables[name + i] <= int(max_)))
+
+        # new variables for XORSampler
+        self.reset_smt()
+        self.record_edges(edges)
+        new_declare = ""
+        for new_var, signal, var_name, number in self.new_var_defs:
+            variables[new_var] = Bool(new_var)
+            assertions.append(variables[new_var] == self.z3_atom(signal, variables[var_name], var_name, number))
+            new_declare += f"(declare-fun {new_var} () Bool)\n"
+        return TreeFormula(self.declare_smt + new_declare, variables, assertions)
@@ -0,0 +1,91 @@
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class Telemetry:
+    """per-loop profile of the main loop of VBT-X, saved as JSON lines
+
+    Each line is the record of one loop: the wall and CPU time and the number of calls of each stage
+    (stages may nest, e.g., "oracle" runs inside "check_disc"), the counters of events, and the fields given to flush.
+    """
+    enabled = True
+
+    def __init__(self, path, position=None):
+        self.path = path
+        if position is not None:
+            # continue from the position (e.g., of the checkpoint a run resumes from), dropping the records after it
+            os.truncate(path, position)
+        self.file = open(path, 'w' if position is None else 'a')
+        self.stages = dict()
+        self.counters = dict()
+
+    def start(self):
+        return time.perf_counter(), time.process_time()
+
+    def stop(self, name, started):
+        # add the time since started (as returned by start) to the stage
+        wall, cpu = time.perf_counter() - started[0], time.process_time() - started[1]
+        stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        stage["calls"] += 1
+
+    @contextmanager
+    def stage(self, name):
+        started = self.start()
+        try:
+            yield
+        finally:
+            self.stop(name, started)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def flush(self, **fields):
+        """write the record of the current loop with the given fields, and start a new record"""
+        record = dict(fields, stages=self.stages, counters=self.counters)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        self.stages = dict()
+        self.counters = dict()
+
+    def position(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class NullTelemetry:
+    """telemetry that records nothing, used when telemetry is off"""
+    enabled = False
+    null_stage = nullcontext()
+
+    def start(self):
+        return None
+
+    def stop(self, name, started):
+        pass
+
+    def stage(self, name):
+        return self.null_stage
+
+    def count(self, name, value=1):
+        pass
+
+    def flush(self, **fields):
+        pass
+
+    def position(self):
+        return None
+
+    def close(self):
+        pass
+
+
+def load_telemetry(path):
+    """load the records saved by Telemetry"""
+    with open(path) as file:
+        return [json.loads(line) for line in file]
@@ -1,10 +1,17 @@
 import random
 import math
-from z3 import Solver
+import time
+import numpy as np
+from z3 import Solver, And, Not
+from utils.IncrementalSolver import IncrementalSolver
+from utils.HashFamily import HashFamily
+from utils.Telemetry import NullTelemetry
 
 
 class XORSampler:
-    def __init__(self, smt_str, param_xor, vbtx_ver="improved", no_of_xor=5, p=.5, max_path=100, max_loop=1000, need_only_one_sol=True, need_blocking=True, need_change_s=True, class_list=["Class"], protected_list=["sex"]):
+    def __init__(self, smt_str, param_xor, vbtx_ver="improved", no_of_xor=5, p=.5, max_path=100, max_loop=1000, need_only_one_sol=True, need_blocking=True, need_change_s=True, class_list=["Class"], protected_list=["sex"], incremental=True, engine=None, formula=None, known_sat=None, telemetry=None,
+                 deadline=None, check_timeout=None, adaptive_xor=False,
+                 xor_density=None, hash_family=None):
         self.smt_str = smt_str
         self.no_of_xor = no_of_xor
         self.p = p
@@ -26,6 +33,7 @@ class XORSampler:
             for index in ['0', '1']:
                 self.protected_list.append(ch+index)
         self.blocking_str = ""
+        self.blocking = list()
         self.res = dict()
         self.samples = list()
 
@@ -33,6 +41,46 @@ class XORSampler:
         self.new_var_list = param_xor["new_var_list"]
         self.old_var_list = param_xor["old_var_list"]
         self.dict_old_to_new = param_xor["dict_old_to_new"]
+        # bit-vector variables hold the offset of each value from the lower bound of its range
+        self.offsets = param_xor.get("offsets", dict())
+        self.order_op = ">" if param_xor.get("encoding", "int") != "bv" else "bvugt"
+        # telling the logic lets Z3 pick a dedicated solver (e.g., bit-blasting to SAT for bit-vectors)
+        self.logic = "QF_LIA" if param_xor.get("encoding", "int") != "bv" else "QF_BV"
+
+        # the incremental engine asserts the base formula once and solves each round in a push/pop scope
+        # a formula given as Z3 expressions (see Tree2SMT.dt_to_formula) is always solved incrementally
+        self.incremental = incremental or formula is not None
+        self.engine = engine
+        if self.engine is None and formula is not None:
+            self.engine = IncrementalSolver(formula.declare_str, assertions=formula.assertions, variables=formula.variables, logic=self.logic)
+        elif self.engine is None and self.incremental:
+            self.engine = IncrementalSolver(self.smt2_content["old"],
+                                            self.smt2_content["tree"] + self.smt2_content["fairness"] + self.smt2_content["new"], logic=self.logic)
+        self.sample_var_list = [ovar + index for ovar in self.old_var_list for index in ['0', '1']]
+        # the satisfiability of the base formula, if it is known already (e.g., from an earlier sampler on the same formula)
+        self.known_sat = known_sat
+        # the time of each Z3 check is recorded in the stage "z3_sat", "z3_unsat" or "z3_unknown" (timeout) of telemetry
+        self.telemetry = NullTelemetry() if telemetry is None else telemetry
+        # the time (as returned by time.time) when sampling is abandoned, and the time limit of each Z3 check in seconds
+        self.deadline = deadline
+        self.check_timeout = check_timeout
+        # whether to adapt the number of XOR constraints by adapt_xor, instead of the rule of need_change_s
+        # (the versions without need_change_s sample with a fixed number of XOR constraints)
+        self.adaptive_xor = adaptive_xor and need_change_s
+        self.solve_times = list() # the solve times of the satisfiable checks
+        self.xor_search = True # whether adapt_xor is searching for the number of XOR constraints
+        self.last_outcome = None # "sat", "unsat" or "unknown" (i.e., timeout) of the last check
+        self.last_solve_time = 0.0
+        # the XOR constraints are drawn from a hash family, whose variables are indexed once per formula (it can be shared
+        # by the samplers of the same formula); each variable (attribute for improved) is in an XOR with probability
+        # xor_density, 1 - p by default, and a smaller density gives sparser XORs
+        self.hash_family = hash_family
+        if self.hash_family is None:
+            self.hash_family = HashFamily(self.new_var_list, self.dict_old_to_new, self.not_equal_list, vbtx_ver=self.vbtx_ver,
+                                          density=1 - p if xor_density is None else xor_density)
+        # seeded from the random module, so that random.seed still makes sampling reproducible
+        self.hash_rng = np.random.default_rng(random.getrandbits(64))
+        self.hashes = list() # the XOR constraints of this round, see HashFamily.draw
 
     def create_input_string(self, in_loop_1=True):
         # update the self.smt_str
@@ -43,7 +91,7 @@ class XORSampler:
         smt_str += self.smt2_content["new"]
 
         if self.vbtx_ver != "naive":
-            smt_str += "(assert (> %s %s))\n" % (self.protected_list[0], self.protected_list[1])
+            smt_str += "(assert (%s %s %s))\n" % (self.order_op, self.protected_list[0], self.protected_list[1])
 
         for lines in self.smt2_content["xor"]:
             smt_str += "%s" % lines
@@ -68,7 +116,38 @@ class XORSampler:
                 self.res[str(item)] = str(model[item])
         return True  # sat
 
+    def save_model(self, model):
+        # save the values of the original variables to self.res, and those of the new variables to self.blocking
+        values = [model.eval(const, model_completion=True) for const in self.engine.get_consts(self.sample_var_list)]
+        self.res = {var: str(value) for var, value in zip(self.sample_var_list, values)}
+        if self.need_only_one_sol or self.need_blocking:
+            self.blocking = [var == model.eval(var, model_completion=True)
+                             for var in map(self.engine.bool_var, self.new_var_list)]
+
+    def check_time_limit(self):
+        # the time limit of the next check: the per-check timeout, or the time left until the deadline if shorter
+        if self.deadline is None:
+            return self.check_timeout
+        time_left = max(0.0, self.deadline - time.time())
+        return time_left if self.check_timeout is None else min(self.check_timeout, time_left)
+
     def have_sol(self):
+        if self.incremental:
+            started = self.telemetry.start()
+            check_started = time.perf_counter()
+            model = self.engine.check(*self.hash_family.to_z3(self.hashes, self.engine.bool_var), timeout=self.check_time_limit())
+            self.last_solve_time = time.perf_counter() - check_started
+            self.last_outcome = str(self.engine.result)
+            if self.telemetry.enabled:
+                # the size of the formula of this check: the number of XOR constraints and of their terms
+                outcome = "z3_" + self.last_outcome
+                self.telemetry.stop(outcome, started)
+                self.telemetry.count(outcome + "_xor", len(self.hashes))
+                self.telemetry.count(outcome + "_xor_terms", HashFamily.size(self.hashes))
+            if model is None:
+                return False
+            self.save_model(model)
+            return True
         self.create_input_string()
         if self.analysis_z3Output():
             self.blocking_str = ""
@@ -80,105 +159,159 @@ class XORSampler:
 
     def generate_XOR(self):
         # generate XOR clauses
-        self.smt2_content["xor"].clear()
-        var_list = self.dict_old_to_new
-        for i in range(0, self.no_of_xor):
-            xor_str = ""
-            if self.vbtx_ver == "naive":
-                for var in self.new_var_list:
-                    if random.random() > self.p:
-                        xor_str += " " + var
-            else:
-                for var_od in var_list:
-                    if var_od not in self.not_equal_list:
-                        if random.random() > self.p:
-                            no_x = random.randint(0, len(var_list[var_od]) - 1)
-                            var = var_list[var_od][no_x]
-                            xor_str += " " + var
-            if random.random() > 0.5:
-                xor_str = xor_str + " true"
-            if xor_str != "":
-                self.smt2_content["xor"].append("(assert (xor%s))\n" % xor_str)
+        self.hashes = self.hash_family.draw(self.no_of_xor, self.hash_rng)
+        if not self.incremental:
+            self.smt2_content["xor"][:] = self.hash_family.to_smt(self.hashes)
 
     def have_another_sol(self):
+        if self.incremental:
+            return self.engine.check(Not(And(self.blocking)), *self.hash_family.to_z3(self.hashes, self.engine.bool_var),
+                                     timeout=self.check_time_limit()) is not None
         self.smt2_content["blocking_loop2"] = "(assert (not (and%s)))\n" % self.blocking_str
         self.create_input_string(in_loop_1=False)
         self.smt2_content["blocking_loop2"] = ""
         return self.analysis_z3Output(in_loop_1=False)
 
+    def adapt_xor(self):
+        """adapt the number of XOR constraints (self.no_of_xor) to the outcome and the solve time of the last check
+
+        This replaces the rule of need_change_s (+20 after 5 satisfiable checks, and halving at the first unsatisfiable check).
+        While searching, the number is doubled after each satisfiable check, and halved at the first check that is
+        unsatisfiable, times out or is slow, which ends the search; then the solutions are sampled.
+        While sampling, the number is decreased by one when a check times out or is slow.
+        A check is slow if it takes more than 4 times the mean time of the satisfiable checks so far.
+
+        Returns:
+            bool: whether the last check was a part of the search
+        """
+        slow = len(self.solve_times) > 0 and self.last_solve_time > 4 * sum(self.solve_times) / len(self.solve_times)
+        if self.last_outcome == "sat" and not slow:
+            self.solve_times.append(self.last_solve_time)
+        if self.xor_search:
+            if self.last_outcome == "sat" and not slow and self.no_of_xor < len(self.new_var_list):
+                self.no_of_xor *= 2
+                self.telemetry.count("xor_count_up")
+            else:
+                self.no_of_xor = max(1, self.no_of_xor // 2)
+                self.xor_search = False
+                self.telemetry.count("xor_count_down")
+            return True
+        if self.no_of_xor > 1 and (self.last_outcome == "unknown" or (slow and len(self.solve_times) >= 5)):
+            self.no_of_xor -= 1
+            self.telemetry.count("xor_count_down")
+        return False
+
     def generate_simple_ins(self):
         res1 = list()
         res2 = list()
         for ovar in self.old_var_list:
-            res1.append(int(self.res[ovar+'0']))
-            res2.append(int(self.res[ovar+'1']))
+            res1.append(int(self.res[ovar+'0']) + self.offsets.get(ovar, 0))
+            res2.append(int(self.res[ovar+'1']) + self.offsets.get(ovar, 0))
         self.samples.append(res1)
         self.samples.append(res2)
 
     def add_blocking(self):
+        if self.incremental:
+            self.engine.add(Not(And(self.blocking)))
+            return
         self.smt2_content["blocking_loop1"].append("(assert (not (and%s)))\n" % self.blocking_str)
     
     def clear_data(self):
         self.res = dict()
         self.blocking_str = ""
-    
+        self.blocking = list()
+
     def sample(self):
         """test cases generation through hashing-based sampling
 
         The goal here is to sample the solutions of the given SMT formula (i.e., self.smt_str) by hashing-based sampling.
         The generated samples is the test cases we need.
+
+        Returns:
+            bool, list: whether a solution is found (None if checking self.smt_str timed out), and the samples
         """
         # check if self.smt_str has any solution
-        solver = Solver()
-        solver.from_string(self.smt_str)
-        if "unsat" == str(solver.check()):
-            # if self.smt_str does not have any solution, there is no need for sampling
-            return False, []
-
-        satFlag = False
-        i = 0
-        no_of_path = 0
-        if self.need_change_s:
-            times = 0
-            change_s = True
+        if self.incremental:
+            # the base formula of the engine only adds definitions of new variables to self.smt_str
+            if self.known_sat is None:
+                with self.telemetry.stage("z3_base_check"):
+                    model = self.engine.check(timeout=self.check_time_limit())
+                if model is None and str(self.engine.result) == "unknown":
+                    # timed out: the satisfiability of the formula stays unknown, which is not reported as unsat
+                    return None, []
+                self.known_sat = model is not None
+            if not self.known_sat:
+                return False, []
+            # constraints added during sampling (protected attribute order, blocking clauses) are kept in one scope
+            self.engine.push()
         else:
-            change_s = False
-
-        while i < self.max_loop and no_of_path < self.max_path:
-            i += 1
-            # randomly generate XOR Clauses
-            self.generate_XOR()
-            # sample a solution
-            satFlag = self.have_sol()
-
-            if satFlag:
-                # sat: found a solution
-                if change_s:
-                    times += 1
-                    if times == 5:
-                        times = 0
-                        self.no_of_xor += 20
-                    continue
-                if self.need_only_one_sol:
-                    # check whether a solution is unique or not
-                    if not self.have_another_sol():
-                        # the solution is unique
-                        pass
-                    else:
-                        # have found another solution
-                        # do not save this solution as a sample
-                        continue
-                # add the solution to the set of samples (i.e., self.samples)
-                self.generate_simple_ins()
-                no_of_path += 1
-                if self.need_blocking:
-                    self.add_blocking()
+            solver = Solver()
+            solver.from_string(self.smt_str)
+            if "unsat" == str(solver.check()):
+                # if self.smt_str does not have any solution, there is no need for sampling
+                return False, []
+
+        try:
+            if self.incremental and self.vbtx_ver != "naive":
+                self.engine.add_string("(assert (%s %s %s))\n" % (self.order_op, self.protected_list[0], self.protected_list[1]))
+            satFlag = False
+            i = 0
+            no_of_path = 0
+            if self.need_change_s and not self.adaptive_xor:
+                times = 0
+                change_s = True
             else:
-                # unsat: there is no solution found
-                if change_s:
-                    self.no_of_xor = math.floor(self.no_of_xor*0.5)
-                    change_s = False
-                continue
+                change_s = False
+
+            while i < self.max_loop and no_of_path < self.max_path:
+                if self.deadline is not None and time.time() >= self.deadline:
+                    # the time budget has run out: abandon this round, keeping the samples found so far
+                    self.telemetry.count("sample_abandoned")
+                    satFlag = len(self.samples) > 0
+                    break
+                i += 1
+                # randomly generate XOR Clauses
+                self.generate_XOR()
+                # sample a solution
+                satFlag = self.have_sol()
+                if self.adaptive_xor and self.adapt_xor():
+                    # no solutions are saved while searching for the number of XOR constraints, as with need_change_s
+                    continue
 
-        self.clear_data()
+                if satFlag:
+                    # sat: found a solution
+                    if change_s:
+                        times += 1
+                        if times == 5:
+                            times = 0
+                            self.no_of_xor += 20
+                            self.telemetry.count("xor_count_up")
+                        continue
+                    if self.need_only_one_sol:
+                        # check whether a solution is unique or not
+                        if not self.have_another_sol():
+                            # the solution is unique
+                            pass
+                        else:
+                            # have found another solution
+                            # do not save this solution as a sample
+                            continue
+                    # add the solution to the set of samples (i.e., self.samples)
+                    self.generate_simple_ins()
+                    no_of_path += 1
+                    if self.need_blocking:
+                        self.add_blocking()
+                else:
+                    # unsat: there is no solution found
+                    if change_s:
+                        self.no_of_xor = math.floor(self.no_of_xor*0.5)
+                        change_s = False
+                        self.telemetry.count("xor_count_down")
+                    continue
+        finally:
+            # the engine may be cached and reused by later loops (see Tester.encode_tree), so its base formula is
+            # restored even if sampling raises
+            if self.incremental:
+                self.engine.pop()
+            self.clear_data()
         return satFlag, self.samples
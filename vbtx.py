@@ -1,62 +1,312 @@
+import os
 import random
 import time
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from sklearn.tree import DecisionTreeClassifier
-import csv
 from utils.XORSampler import XORSampler
-from utils.SearchTree import Tree2SMT
+from utils.SearchTree import Tree2SMT, tree_fingerprint
+from utils.BoxSampler import BoxSampler, compatible_leaf_nodes
+from utils.ResultSink import open_sinks
+from utils.RowPacker import RowPacker
+from utils.IncrementalTree import IncrementalTree
+from utils.Telemetry import Telemetry, NullTelemetry
+from utils.Checkpoint import save_checkpoint, load_checkpoint, checkpoint_path
 import logging
 
 
+# parameters of XORSampler for each version of VBT-X
+XOR_SAMPLER_PARAMS = {
+    "improved": dict(vbtx_ver="improved", max_loop=1000, max_path=50, no_of_xor=5,
+                     need_only_one_sol=False, need_change_s=True, need_blocking=False),
+    "improveds10": dict(vbtx_ver="improved", max_loop=1000, max_path=50, no_of_xor=10,
+                        need_only_one_sol=False, need_change_s=False, need_blocking=False),
+    "naive": dict(vbtx_ver="naive", max_loop=1000, max_path=50, no_of_xor=10,
+                  need_only_one_sol=False, need_change_s=False, need_blocking=False),
+}
+
+
+def sample_worker(smt_str, param_xor, sampler_params, seed):
+    # run one XORSampler in a worker process, which has its own Z3 context
+    random.seed(seed)
+    sampler = XORSampler(smt_str=smt_str, param_xor=param_xor, **sampler_params)
+    return sampler.sample()
+
+
+class Target:
+    """a target of fairness testing: the protected attributes in which the two individuals of a test case differ
+
+    The targets of a Tester share its training data and decision trees, and each has its own SMT encoding and results.
+    """
+    def __init__(self, protected_att, feature_list, tree2smt):
+        self.protected_att = protected_att
+        self.protected_list = [feature_list[i] for i in protected_att]
+        self.name = "+".join(self.protected_list) # e.g., "sex" or, for an intersection, "sex+race"
+        self.tree2smt = tree2smt
+        self.no_test = 0
+        self.no_disc = 0
+        self.test_sink = None
+        self.disc_sink = None
+
+
+class TestBatch:
+    """the results of the test cases generated for a target in a loop, as yielded by Tester.iter_tests"""
+    def __init__(self, target, test_data, disc_data, no_new_train):
+        self.target = target.name
+        self.test_data = test_data # the test cases, as pairs of consecutive rows (without those checked before, with dedup)
+        self.disc_data = disc_data # the discriminatory instances among test_data, as pairs of consecutive rows
+        self.no_new_train = no_new_train # the number of test cases added to the training data
+        self.loop = None # the loop that yields the batch
+        self.elapsed = None # the time since the start of the test when the batch is yielded, in seconds
+
+
 class BlackBoxModel:
-    def __init__(self, data_range, predict_func, feature_list):
+    def __init__(self, data_range, predict_func, feature_list, batch_size=None, cache_size=None):
         self.no_attr = len(data_range)
         self.data_range = data_range # e.g., [[1, 2], [3, 4]]
         self.predict_func = predict_func
         self.feature_list = feature_list
+        self.batch_size = batch_size # None: query all inputs in one call
+        # LRU cache of at most cache_size predictions, keyed by packed input (None: no cache)
+        self.cache_size = cache_size
+        self.cache = None if cache_size is None else OrderedDict()
+        self.packer = None if cache_size is None else RowPacker(data_range)
+        self.cache_hits = 0 # inputs served from the cache
+        self.cache_misses = 0 # inputs not in the cache (hits + misses: all the inputs predicted with the cache)
+        self.cache_queries = 0 # distinct inputs sent to predict_func, as an input repeated in a batch is sent once
+        self.lock = threading.Lock() # guards the cache against predict_async
+        self.executor = None
+
+    def query(self, inputs):
+        if self.batch_size is None or len(inputs) <= self.batch_size:
+            return self.predict_func(inputs)
+        chunks = [inputs[i:i + self.batch_size] for i in range(0, len(inputs), self.batch_size)]
+        if hasattr(self.predict_func, "submit"):
+            # an asynchronous oracle (e.g., AsyncOracle) evaluates the chunks concurrently
+            futures = [self.predict_func.submit(chunk) for chunk in chunks]
+            return np.concatenate([future.result() for future in futures])
+        return np.concatenate([self.predict_func(chunk) for chunk in chunks])
 
     def predict(self, inputs):
-        outputs = self.predict_func(inputs)
-        return outputs
+        """predict the outputs of the given inputs
+
+        With the cache, the inputs predicted before are served from the cache,
+        and only the other (distinct) inputs are sent to self.predict_func, in a single batch.
+        """
+        if len(inputs) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if self.cache is None:
+            return self.query(inputs)
+        with self.lock:
+            return self.predict_cached(inputs)
+
+    def predict_cached(self, inputs):
+        keys = self.packer.pack(inputs)
+        outputs = [None] * len(keys)
+        misses = dict() # key -> positions of the inputs not in the cache
+        for i, key in enumerate(keys):
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                outputs[i] = self.cache[key]
+            else:
+                misses.setdefault(key, []).append(i)
+        no_miss = sum(len(positions) for positions in misses.values())
+        self.cache_hits += len(keys) - no_miss
+        self.cache_misses += no_miss
+        self.cache_queries += len(misses)
+        if misses:
+            miss_inputs = np.asarray(inputs, dtype=np.int64)[[positions[0] for positions in misses.values()]]
+            for (key, positions), output in zip(misses.items(), self.query(miss_inputs)):
+                self.cache[key] = output
+                for i in positions:
+                    outputs[i] = output
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return np.asarray(outputs)
+
+    def predict_async(self, inputs):
+        """predict the outputs of the given inputs in a background thread
+
+        Returns:
+            concurrent.futures.Future: the future of the outputs, as returned by predict
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(self.predict, inputs)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def cache_info(self):
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "queries": self.cache_queries,
+                "size": 0 if self.cache is None else len(self.cache)}
 
 
 class Tester:
-    def __init__(self, black_box_model: "BlackBoxModel", protected_list, no_train_data_sample, vbtx_ver="improved", show_logging=False):
+    def __init__(self, black_box_model: "BlackBoxModel", protected_list, no_train_data_sample, vbtx_ver="improved", show_logging=False, seed=None, smt_backend="smtlib", smt_encoding="int", n_workers=1,
+                 output_format=("csv",), keep_results=True, dedup=False, overlap_oracle=False, surrogate_update="full",
+                 encoding_cache_size=8, telemetry=False, check_timeout=None, adaptive_xor=False,
+                 prune_leaf_pairs=False, xor_density=None, train_pool=None):
         self.black_box_model = black_box_model
-        self.tree2smt = Tree2SMT(feature_names=self.black_box_model.feature_list[:-1],
-                                 class_name=self.black_box_model.feature_list[-1], protected_att=protected_list, vbtx_ver=vbtx_ver)
+        # protected_list -- the indexes of the protected attributes of one target,
+        # or a list of such lists to test several targets (e.g., [[8], [7], [8, 7]]) in the same session
+        if protected_list and isinstance(protected_list[0], (list, tuple)):
+            targets = [list(protected_att) for protected_att in protected_list]
+        else:
+            targets = [list(protected_list)]
+        # smt_encoding -- "int": unbounded integers, "bounded_int": integers within data_range, "bv": bit-vectors within data_range
+        self.targets = [Target(protected_att, self.black_box_model.feature_list,
+                               Tree2SMT(feature_names=self.black_box_model.feature_list[:-1],
+                                        class_name=self.black_box_model.feature_list[-1], protected_att=protected_att, vbtx_ver=vbtx_ver,
+                                        encoding="bv" if smt_encoding == "bv" else "int",
+                                        data_range=None if smt_encoding == "int" else self.black_box_model.data_range))
+                        for protected_att in targets]
         self.train_data = list()
+        # surrogate_update -- "full": refit the decision tree in every loop, "skip": refit only when new training data is added,
+        # "leaf": refit only the subtrees of the leaves that misclassify new training data
+        self.surrogate_update = surrogate_update
+        self.DT = None
+        self.no_fitted = 0 # the number of training data that self.DT is fitted on
+        self.no_fit = 0
+        self.fit_time = 0.0
         self.disc_data = list()
         self.test_data = list()
-        self.protected_list = [self.black_box_model.feature_list[i] for i in protected_list]
+        self.protected_att = self.targets[0].protected_att
+        self.protected_list = self.targets[0].protected_list
         self.no_train_data_sample = no_train_data_sample
         self.vbtx_ver = vbtx_ver
+        self.smt_backend = smt_backend # "smtlib": SMT-LIB text, "z3": Z3 expressions built directly from the tree
+        self.n_workers = n_workers # the number of processes sampling from the same decision tree in each loop
+        self.pool = None
+        # encodings of the latest encoding_cache_size decision trees, keyed by tree_fingerprint (0: no cache)
+        self.encoding_cache_size = encoding_cache_size
+        self.encoding_cache = OrderedDict()
+        self.encoding_cache_hits = 0
+        self.output_format = output_format # formats of the result files: "csv" and/or "npy" (chunks of NumPy arrays)
+        self.keep_results = keep_results # whether to keep all the results in self.test_data and self.disc_data
+        # indexes of the (packed) test cases and discriminatory instances found so far
+        self.packer = RowPacker(self.black_box_model.data_range)
+        self.test_index = set()
+        self.disc_index = set()
+        self.dedup = dedup # whether to drop the test cases that have been checked before
+        # whether to query black box model for the test cases of a loop while the next loop generates test cases
+        self.overlap_oracle = overlap_oracle
+        # whether to save the per-loop profile of the main loop to ./Telemetry (see utils.Telemetry)
+        self.telemetry_enabled = telemetry
+        self.telemetry = NullTelemetry()
+        self.check_timeout = check_timeout # the time limit of each Z3 check in seconds (None: no limit)
+        self.adaptive_xor = adaptive_xor # whether to adapt the number of XOR constraints by XORSampler.adapt_xor
+        # whether to encode only the pairs of leaves that can yield a discriminatory instance (see Tree2SMT.dt_to_smt)
+        self.prune_leaf_pairs = prune_leaf_pairs
+        # the probability that each variable (attribute for improved) is in an XOR constraint (None: 1 - p, i.e., 0.5)
+        self.xor_density = xor_density
+        # a utils.LabeledPool.LabeledPool of inputs labeled by black box model, shared with other testers of the same model,
+        # to draw the training data from (None: label new inputs for each training data)
+        self.train_pool = train_pool
+        self.deadline_time = None # the time when the current test ends, as returned by time.time
         self.no_test = 0
         self.no_disc = 0
+        self.start_time = None # the time when the current test started (shifted by the time before the checkpoint it resumes from)
+        # the time from the start of the test to the first discriminatory instance, in seconds (None: not found yet)
+        self.first_disc_time = None
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+        if seed is not None:
+            # XORSampler draws its hash functions from the random module
+            random.seed(seed)
         if show_logging:
             logging.basicConfig(format="",level=logging.INFO)
         else:
             logging.basicConfig(level=logging.CRITICAL + 1)
 
     def create_train_data(self, num):
-        self.train_data = list()
-        black_model = self.black_box_model
-        data_range = black_model.data_range
-        for _ in range(num):
-            temp = list()
-            for i in range(black_model.no_attr):
-                temp.append(random.randint(data_range[i][0], data_range[i][1]))
-            temp.append(int(black_model.predict([temp])))
-            self.train_data.append(temp)
+        """Sample training data uniformly from the input domain of black box model
+
+        The training data are drawn from self.train_pool if any, which labels new inputs only when it is too small,
+        or else are labeled by label_uniform_data.
+        The result is saved to self.train_data as an array whose last column is the label.
+
+        Args:
+            num (int): the number of training data
+        """
+        # the decision trees of the new training data share no encodings with the old ones
+        self.encoding_cache.clear()
+        if self.train_pool is None:
+            self.train_data = self.label_uniform_data(num)
+            return
+        no_labeled = self.train_pool.no_labeled
+        self.train_data = self.train_pool.draw(num, self.rng, self.label_uniform_data)
+        self.telemetry.count("train_pool_labeled", self.train_pool.no_labeled - no_labeled)
+
+    def label_uniform_data(self, num):
+        """Label num inputs drawn uniformly from the input domain of black box model
+
+        All inputs are drawn at once as an integer matrix over self.black_box_model.data_range,
+        and labeled by black box model in a single (or, if batch_size is set, chunked) call.
+
+        Returns:
+            numpy.ndarray: the inputs with their labels as the last column
+        """
+        data_range = np.asarray(self.black_box_model.data_range, dtype=np.int64)
+        X = self.rng.integers(data_range[:, 0], data_range[:, 1], size=(num, len(data_range)), endpoint=True)
+        with self.telemetry.stage("oracle"):
+            Y = np.asarray(self.black_box_model.predict(X), dtype=np.int64)
+        return np.column_stack((X, Y))
+
+    @property
+    def train_data(self):
+        return self.train_buffer[:self.no_train_data]
+
+    @train_data.setter
+    def train_data(self, rows):
+        self.train_buffer = np.array(rows, dtype=np.int64).reshape(-1, self.black_box_model.no_attr + 1)
+        self.no_train_data = len(self.train_buffer)
+        self.DT = None
+
+    def add_train_data(self, rows):
+        """append rows to the training data, doubling the capacity of the buffer when it is full"""
+        rows = np.asarray(rows, dtype=np.int64)
+        if self.no_train_data + len(rows) > len(self.train_buffer):
+            buffer = np.empty((max(2 * len(self.train_buffer), self.no_train_data + len(rows)), self.train_buffer.shape[1]), dtype=np.int64)
+            buffer[:self.no_train_data] = self.train_data
+            self.train_buffer = buffer
+        self.train_buffer[self.no_train_data:self.no_train_data + len(rows)] = rows
+        self.no_train_data += len(rows)
+
+    def make_classifier(self):
+        # with a seed, the ties between the splits of the decision tree are also broken reproducibly
+        random_state = None if self.seed is None else int(self.rng.integers(2 ** 31))
+        return DecisionTreeClassifier(criterion="entropy", splitter="best", max_depth=None, min_samples_split=2,
+                                      min_samples_leaf=1, min_weight_fraction_leaf=0.0, max_features=None,
+                                      random_state=random_state)
 
     def train_approximate_DT(self):
-        X = [item[:-1] for item in self.train_data]
-        Y = [item[-1] for item in self.train_data]
-        clf = DecisionTreeClassifier(criterion="entropy", splitter="best", max_depth=None, min_samples_split=2,
-                                    min_samples_leaf=1, min_weight_fraction_leaf=0.0, max_features=None,
-                                    random_state=None)
-        return clf.fit(X, Y)
-
-    def check_disc(self, testdata):
+        """Fit (or update) the approximation model of black box model on the training data
+
+        Depending on self.surrogate_update, the decision tree of the previous loop is reused
+        if no training data has been added since, or is updated on the new training data only.
+        """
+        if self.surrogate_update != "full" and self.DT is not None and self.no_fitted == self.no_train_data:
+            return self.DT
+        start_time = time.time()
+        X = self.train_data[:, :-1]
+        Y = self.train_data[:, -1]
+        if self.surrogate_update == "leaf":
+            if self.DT is None or not self.DT.update(X, Y, self.no_fitted):
+                self.DT = IncrementalTree(self.make_classifier).fit(X, Y)
+        else:
+            self.DT = self.make_classifier().fit(X, Y)
+        self.no_fitted = self.no_train_data
+        self.no_fit += 1
+        self.fit_time += time.time() - start_time
+        return self.DT
+
+    def check_disc(self, testdata, real_Y=None):
         """Execute test cases against black box model
 
         For each test cases, check whether the test case are discriminatory instances of black box model (self.black_box_model),
@@ -65,116 +315,426 @@ class Tester:
 
         Args:
             testdata (list): the set of test cases
+            real_Y (list): the outputs of black box model for the test cases, if they have been queried already
 
         Returns:
             int: the number of test cases that are added to training data (self.train_data)
         """
         no_test = len(testdata) // 2
-        X = [item[:-1] for item in testdata]
-        Y = [int(item[-1]) for item in testdata]
-        real_Y = self.black_box_model.predict(X)
-        count = 0
-        train_data_count = 0
-        for i in range(0, no_test * 2, 2):
-            equal1 = True if Y[i] == real_Y[i] else False
-            equal2 = True if Y[i + 1] == real_Y[i + 1] else False
-            if not equal1:
-                self.train_data.append(X[i] + [real_Y[i]])
-                train_data_count += 1
-            if not equal2:
-                self.train_data.append(X[i + 1] + [real_Y[i + 1]])
-                train_data_count += 1
-
-            if equal1 and equal2:
-                self.disc_data.append(testdata[i])
-                self.disc_data.append(testdata[i + 1])
-                self.no_disc += 1
-                count += 1
+        if no_test == 0:
+            return 0
+        # the test cases as an array of (test case, individual, attribute), whose last attribute is the output of the decision tree
+        pairs = np.asarray(testdata[:2 * no_test], dtype=np.int64).reshape(no_test, 2, -1)
+        X = pairs[:, :, :-1]
+        if real_Y is None:
+            with self.telemetry.stage("oracle"):
+                real_Y = self.black_box_model.predict(X.reshape(2 * no_test, -1))
+        real_Y = np.asarray(real_Y, dtype=np.int64)[:2 * no_test].reshape(no_test, 2)
+        equal = pairs[:, :, -1] == real_Y
+
+        # the individuals on which the decision tree fails are added to the training data, in the order of testdata
+        mismatch = ~equal
+        train_data_count = int(mismatch.sum())
+        if train_data_count:
+            self.add_train_data(np.column_stack((X[mismatch], real_Y[mismatch])))
+
+        # the test cases on which the decision tree is right for both individuals are discriminatory instances
+        disc_pairs = pairs[equal.all(axis=1)]
+        self.no_disc += len(disc_pairs)
+        if len(disc_pairs) > 0:
+            disc_keys = self.packer.pack_pairs(disc_pairs[:, :, :-1].reshape(2 * len(disc_pairs), -1))
+            if self.dedup:
+                new_disc = list()
+                for i, disc_key in enumerate(disc_keys):
+                    if disc_key not in self.disc_index:
+                        self.disc_index.add(disc_key)
+                        new_disc.append(i)
+                disc_pairs = disc_pairs[new_disc]
+            else:
+                self.disc_index.update(disc_keys)
+            self.disc_data += disc_pairs.reshape(2 * len(disc_pairs), -1).tolist()
         return train_data_count
 
-    def test(self, deadline=None, max_test_data=None, label=("res", 0)):
+    def execute_tests(self, test_data, future, target):
+        """Check test cases by check_disc and save the results
+
+        Args:
+            future: the future of the outputs of black box model for test_data (None: query black box model now)
+            target (Target): the target that test_data are generated for
+
+        Returns:
+            TestBatch: the test cases and the discriminatory instances found among them
+        """
+        no_disc_data = len(self.disc_data)
+        no_disc = self.no_disc
+        real_Y = None
+        if future is not None:
+            with self.telemetry.stage("oracle"):
+                real_Y = future.result()
+        with self.telemetry.stage("check_disc"):
+            no_new_train = self.check_disc(test_data, real_Y)
+        target.no_disc += self.no_disc - no_disc
+        disc_data = self.disc_data[no_disc_data:]
+        target.test_sink.write(test_data)
+        target.disc_sink.write(disc_data)
+        if self.keep_results:
+            self.test_data += test_data
+        else:
+            del self.disc_data[:]
+        if self.first_disc_time is None and disc_data:
+            self.first_disc_time = time.time() - self.start_time
+        return TestBatch(target, test_data, disc_data, no_new_train)
+
+    def index_test_data(self, testdata):
+        """Add test cases to the index of test cases (self.test_index)
+
+        Returns:
+            list: the test cases that have not been generated before
+        """
+        new_test_data = list()
+        keys = self.packer.pack_pairs([item[:-1] for item in testdata])
+        for i, key in enumerate(keys):
+            if key not in self.test_index:
+                self.test_index.add(key)
+                new_test_data += testdata[2 * i:2 * i + 2]
+        return new_test_data
+
+    def generate_test_data(self, DT, target=None):
+        """Generate test cases from the approximation model DT for target (default: the first target)
+
+        Construct an SMT formula from DT, and sample its solutions by SMT solver and hashing-based sampling.
+        With self.n_workers > 1, the formula is sent as SMT-LIB text to the worker processes,
+        each of which samples with its own XOR hash functions, and all the samples are merged.
+        The encoding of a tree seen in an earlier loop is reused (see encode_tree).
+        The box version samples from the leaves of DT directly.
+
+        Returns:
+            bool, list: whether at least one test case is found (None if the check of the formula timed out), and the test cases
+        """
+        target = self.targets[0] if target is None else target
+        if self.vbtx_ver == "box":
+            sampler = BoxSampler(DT.tree_, self.black_box_model.data_range, target.protected_att, self.rng, max_path=50)
+            return sampler.sample()
+        if self.vbtx_ver not in XOR_SAMPLER_PARAMS:
+            print("No such version of vbt-x")
+            exit()
+        sampler_params = dict(XOR_SAMPLER_PARAMS[self.vbtx_ver], class_list=[self.black_box_model.feature_list[-1]],
+                              protected_list=target.protected_list, deadline=self.deadline_time,
+                              check_timeout=self.check_timeout, adaptive_xor=self.adaptive_xor, xor_density=self.xor_density)
+
+        encoding = self.encode_tree(DT, target)
+        if encoding["sat"] is False:
+            # the formula of this tree is known to have no solution
+            return False, []
+
+        if self.pool is not None:
+            seeds = self.rng.integers(2 ** 32, size=self.n_workers).tolist()
+            results = self.pool.starmap(sample_worker, [(encoding["smt_str"], encoding["param_xor"], sampler_params, seed) for seed in seeds])
+            test_data = [ins for _, samples in results for ins in samples]
+            if test_data:
+                encoding["sat"] = True
+            if any(satFlag for satFlag, _ in results):
+                return True, test_data
+            return (None if any(satFlag is None for satFlag, _ in results) else False), test_data
+
+        sampler = XORSampler(smt_str=encoding["smt_str"], param_xor=encoding["param_xor"], formula=encoding["formula"],
+                             engine=encoding["engine"], known_sat=encoding["sat"], hash_family=encoding.get("hash_family"),
+                             telemetry=self.telemetry, **sampler_params)
+        result = sampler.sample()
+        # the engine keeps the base formula (the scope of the sampling is popped), so the next sampler can reuse it,
+        # and so does the hash family its variables
+        encoding["engine"], encoding["sat"], encoding["hash_family"] = sampler.engine, sampler.known_sat, sampler.hash_family
+        return result
+
+    def encode_tree(self, DT, target):
+        """Encode DT into an SMT formula for target, reusing the encoding of the same tree in an earlier loop
+
+        Returns:
+            dict: the SMT-LIB text ("smt_str") or Z3 expressions ("formula") of DT, the parameters of XORSampler ("param_xor"),
+                and, once known, the solver with the formula asserted ("engine") and the satisfiability of the formula ("sat")
+        """
+        key = (tree_fingerprint(DT.tree_), target.name) if self.encoding_cache_size > 0 else None
+        if key in self.encoding_cache:
+            self.encoding_cache.move_to_end(key)
+            self.encoding_cache_hits += 1
+            self.telemetry.count("encoding_cache_hit")
+            return self.encoding_cache[key]
+        with self.telemetry.stage("encode"):
+            leaf_pairs = None
+            if self.prune_leaf_pairs:
+                leaf_pairs = compatible_leaf_nodes(DT.tree_, self.black_box_model.data_range, target.protected_att)
+                self.telemetry.count("leaf_pairs", len(leaf_pairs[0]))
+            if leaf_pairs is not None and len(leaf_pairs[0]) == 0:
+                # no pair of leaves can yield a discriminatory instance, so the formula has no solution
+                encoding = {"smt_str": None, "formula": None, "param_xor": None, "engine": None, "sat": False}
+            else:
+                if self.pool is None and self.smt_backend == "z3":
+                    encoding = {"smt_str": None, "formula": target.tree2smt.dt_to_formula(DT, leaf_pairs)}
+                else:
+                    encoding = {"smt_str": target.tree2smt.dt_to_smt(DT, leaf_pairs), "formula": None}
+                encoding.update({"param_xor": target.tree2smt.get_parm_xor(), "engine": None, "sat": None})
+        if key is not None:
+            self.encoding_cache[key] = encoding
+            while len(self.encoding_cache) > self.encoding_cache_size:
+                self.encoding_cache.popitem(last=False)
+        return encoding
+
+    def get_state(self):
+        """Return the state of the test to be saved to a checkpoint
+
+        The decision tree and the caches are not saved: they are rebuilt after resuming.
+        The results are not saved either, as the sinks hold them (see read_results),
+        unless they are kept (keep_results) without any sink to read them back from.
+        """
+        state = {"train_data": self.train_data.copy(), "no_test": self.no_test, "no_disc": self.no_disc,
+                 "test_index": self.test_index, "disc_index": self.disc_index,
+                 "rng": self.rng.bit_generator.state, "random": random.getstate(),
+                 "no_fit": self.no_fit, "fit_time": self.fit_time, "encoding_cache_hits": self.encoding_cache_hits,
+                 "first_disc_time": self.first_disc_time, "targets": [(target.no_test, target.no_disc) for target in self.targets]}
+        if self.keep_results and not self.output_format:
+            # arrays are far more compact than lists of rows
+            state["test_data"] = np.asarray(self.test_data, dtype=np.int64)
+            state["disc_data"] = np.asarray(self.disc_data, dtype=np.int64)
+        return state
+
+    def set_state(self, state):
+        """Restore the state returned by get_state"""
+        self.train_data = state["train_data"]
+        self.no_test, self.no_disc = state["no_test"], state["no_disc"]
+        self.test_index, self.disc_index = state["test_index"], state["disc_index"]
+        self.test_data = state["test_data"].tolist() if "test_data" in state else list()
+        self.disc_data = state["disc_data"].tolist() if "disc_data" in state else list()
+        self.rng.bit_generator.state = state["rng"]
+        random.setstate(state["random"])
+        self.no_fit, self.fit_time, self.encoding_cache_hits = state["no_fit"], state["fit_time"], state["encoding_cache_hits"]
+        self.first_disc_time = state.get("first_disc_time")
+        self.encoding_cache.clear()
+        for target, (no_test, no_disc) in zip(self.targets, state["targets"]):
+            target.no_test, target.no_disc = no_test, no_disc
+
+    def read_results(self):
+        """Read the results saved by the sinks of the targets back to self.test_data and self.disc_data (e.g., after resuming)
+
+        With several targets, the results are ordered by target rather than by loop.
+        """
+        self.test_data = [row for target in self.targets for row in target.test_sink.read()]
+        self.disc_data = [row for target in self.targets for row in target.disc_sink.read()]
+
+    def test(self, deadline=None, max_test_data=None, label=("res", 0), checkpoint_interval=None, resume=False):
         """run a fairness test
 
         perform a fairness testing for black box model (self.black_box_model) against protected attributes (self.protected_list)
+        or, with several targets (self.targets), against each of them (see iter_tests for the arguments)
+
+        Returns:
+            the detected discriminatory instances and generated test cases will be saved to ./DiscData and ./TestData,
+            where the results of each loop are appended to the files as soon as they are produced
+        """
+        for _ in self.iter_tests(deadline, max_test_data, label, checkpoint_interval, resume):
+            pass
+
+    def iter_tests(self, deadline=None, max_test_data=None, label=("res", 0), checkpoint_interval=None, resume=False):
+        """run a fairness test, yielding the results of each loop as soon as they are checked
+
+        In each loop, test cases are generated for every target from the same decision tree,
+        and the counterexamples of all the targets are added to the same training data.
+        The results are also saved as by test. The consumer may stop the test at any time by closing the generator
+        (e.g., by breaking out of a for loop over it), which ends the test at once
+        (the test cases in flight with overlap_oracle are dropped).
 
         Args:
             deadline (int): the runtime in seconds
             max_test_data (int): when the number of test cases reaches this specified value, the test is terminated
             label (tuple): related to the filename of the results
+            checkpoint_interval (float): save the state of the test to ./Checkpoint every checkpoint_interval seconds
+                (None: no checkpoint), and mark the checkpoint as completed at the end of the test
+                (a test stopped by the consumer resumes from its last checkpoint)
+            resume (bool): whether to resume the test from its checkpoint, if any;
+                the deadline and max_test_data count what was done before the checkpoint, and a completed test is not run again
 
-        Returns:
-            the detected discriminatory instances and generated test cases will be saved to ./DiscData and ./TestData
+        Yields:
+            TestBatch: the test cases of a target in a loop and the discriminatory instances found among them
         """
-        start_time = time.time()
+        path = checkpoint_path(label)
+        state = load_checkpoint(path) if resume else None
+        if state is not None and state["completed"]:
+            logging.info(f"The fairness test {label[0]}-{label[1]} was completed before")
+            return
+        self.start_time = time.time()
         restart_flag = True
         self.no_test = 0
+        self.first_disc_time = None
         no_new_train_count = 0
         loop = 0
+        if state is not None:
+            logging.info(f"Resuming from {path} after loop {state['loop']}")
+            self.set_state(state)
+            self.start_time -= state["elapsed"]
+            restart_flag, no_new_train_count, loop = state["restart_flag"], state["no_new_train_count"], state["loop"]
+        start_time = self.start_time
+        last_checkpoint = time.time()
+        # the deadline is also passed to XORSampler, which abandons sampling when it is reached
+        self.deadline_time = None if deadline is None else start_time + deadline
+        pending = None # the test cases (with the future of their outputs, and their target) whose results are not used yet
+
+        if self.n_workers > 1 and self.vbtx_ver in XOR_SAMPLER_PARAMS:
+            self.pool = multiprocessing.Pool(processes=self.n_workers)
 
         # main loop of VBT-X
         logging.info(f"Starting fairness test -- {label[0]}")
-        while True:
-            loop += 1
-            if (deadline is not None) and (time.time() - start_time >= deadline):
-                break
-            if (max_test_data is not None) and (self.no_test >= max_test_data):
-                break
-
-            # Step1: make an approximation model DT of black box model
-            if restart_flag:
-                self.create_train_data(self.no_train_data_sample)
-                restart_flag = False
-            DT = self.train_approximate_DT()
-
-            # Step2: Construct an SMT formula from DT
-            smt_str = self.tree2smt.dt_to_smt(DT)
-            param_xor = self.tree2smt.get_parm_xor()
-
-            # Step3: Generate test cases by SMT solver and hashing-based sampling
-            if self.vbtx_ver == "improved":
-                sampler = XORSampler(smt_str=smt_str, param_xor=param_xor, max_loop=1000, max_path=50, no_of_xor=5,
-                                     need_only_one_sol=False, need_change_s=True, need_blocking=False,
-                                     class_list=[self.black_box_model.feature_list[-1]], protected_list=self.protected_list)
-            elif self.vbtx_ver == "improveds10":
-                sampler = XORSampler(smt_str=smt_str, param_xor=param_xor, max_loop=1000, max_path=50, no_of_xor=10,
-                                     need_only_one_sol=False, need_change_s=False, need_blocking=False,
-                                     class_list=[self.black_box_model.feature_list[-1]], protected_list=self.protected_list)
-            elif self.vbtx_ver == "naive":
-                sampler = XORSampler(smt_str=smt_str, param_xor=param_xor, vbtx_ver="naive", max_loop=1000, max_path=50, no_of_xor=10,
-                                     need_only_one_sol=False, need_change_s=False, need_blocking=False,
-                                     class_list=[self.black_box_model.feature_list[-1]], protected_list=self.protected_list)
-            else:
-                print("No such version of vbt-x")
-                exit()
-            satFlag, test_data = sampler.sample()
-
-            if satFlag:
-                # if at least one test cases is found
-                # Step4: Execute test cases against black box model,
-                # and Step5: Update the training dataset
-                self.no_test += len(test_data) // 2
-                self.test_data += test_data
-                if self.check_disc(test_data) == 0:
+        # when resuming, the results written after the checkpoint are dropped, as they will be produced again
+        for i, target in enumerate(self.targets):
+            # the results of several targets are saved to separate files, e.g., TestData/<label[0]>-sex+race-<label[1]>.csv
+            name = f"{label[0]}-{label[1]}" if len(self.targets) == 1 else f"{label[0]}-{target.name}-{label[1]}"
+            logging.info(f"Saving the generated test cases to TestData/{name}")
+            target.test_sink = open_sinks("TestData", name, self.output_format,
+                                          position=None if state is None else state["test_sink"][i])
+            logging.info(f"Saving the detected discriminatory instances to DiscData/{name}")
+            target.disc_sink = open_sinks("DiscData", name, self.output_format,
+                                          position=None if state is None else state["disc_sink"][i])
+        if state is not None and self.keep_results and self.output_format:
+            # the results before the checkpoint are not in the checkpoint, but in the sinks (truncated to the checkpoint)
+            self.read_results()
+        if self.telemetry_enabled:
+            logging.info(f"Saving the profile of each loop to Telemetry/{label[0]}-{label[1]}.jsonl")
+            os.makedirs("Telemetry", exist_ok=True)
+            self.telemetry = Telemetry(os.path.join("Telemetry", f"{label[0]}-{label[1]}.jsonl"),
+                                       position=None if state is None else state["telemetry"])
+        try:
+            while True:
+                loop += 1
+                if (deadline is not None) and (time.time() - start_time >= deadline):
+                    break
+                if (max_test_data is not None) and (self.no_test >= max_test_data):
+                    break
+
+                # Step1: make an approximation model DT of black box model
+                loop_started = self.telemetry.start()
+                no_test, no_disc = self.no_test, self.no_disc
+                batches = list()
+                if restart_flag:
+                    with self.telemetry.stage("train_data"):
+                        self.create_train_data(self.no_train_data_sample)
+                    restart_flag = False
+                with self.telemetry.stage("fit"):
+                    DT = self.train_approximate_DT()
+
+                # Step2 and Step3: Generate test cases from DT, for each target
+                satFlag = False
+                timed_out = False
+                no_new_train = None
+                for target in self.targets:
+                    with self.telemetry.stage("generate"):
+                        target_sat, test_data = self.generate_test_data(DT, target)
+                    if target_sat is None:
+                        # the check of the formula timed out: this target is skipped in this loop
+                        timed_out = True
+                        continue
+                    if not target_sat:
+                        continue
+                    # if at least one test cases is found
+                    satFlag = True
+                    self.no_test += len(test_data) // 2
+                    target.no_test += len(test_data) // 2
+                    new_test_data = self.index_test_data(test_data)
+                    if self.dedup:
+                        # the test cases checked before need no more queries to black box model
+                        test_data = new_test_data
+                    if self.overlap_oracle:
+                        # Step4 of this loop runs in the background, and Step5 uses the results of the previous loop (or target)
+                        future = self.black_box_model.predict_async([item[:-1] for item in test_data])
+                        previous, pending = pending, (test_data, future, target)
+                        batch = None if previous is None else self.execute_tests(*previous)
+                    else:
+                        # Step4: Execute test cases against black box model,
+                        # and Step5: Update the training dataset
+                        batch = self.execute_tests(test_data, None, target)
+                    if batch is not None:
+                        batches.append(batch)
+                        no_new_train = (no_new_train or 0) + batch.no_new_train
+
+                if satFlag:
+                    if no_new_train == 0:
+                        no_new_train_count += 1
+                        if no_new_train_count >= 5:
+                            restart_flag = True
+                            no_new_train_count = 0
+                            self.telemetry.count("restart_stagnation")
+                    elif no_new_train is not None:
+                        no_new_train_count = 0
+                elif timed_out:
+                    # a hard tree is no reason to discard the training data, unless the next trees are just as hard
+                    self.telemetry.count("skip_timeout")
                     no_new_train_count += 1
                     if no_new_train_count >= 5:
                         restart_flag = True
                         no_new_train_count = 0
+                        self.telemetry.count("restart_timeout")
+                    logging.info(f"Skipping this loop as the check of the formula timed out")
                 else:
-                    no_new_train_count = 0
-            else:
-                # if no test cases can be found from the decision tree, then restart the loop
-                restart_flag = True
-                logging.info(f"Restarting due to not finding any test cases in this loop")
-            logging.info(f"Loop {loop}: #Disc={len(self.disc_data)//2}, #Test={self.no_test}")
+                    # if no test cases can be found from the decision tree, then restart the loop
+                    restart_flag = True
+                    self.telemetry.count("restart_unsat")
+                    logging.info(f"Restarting due to not finding any test cases in this loop")
+                logging.info(f"Loop {loop}: #Disc={self.no_disc} (unique {len(self.disc_index)}), "
+                             f"#Test={self.no_test} (unique {len(self.test_index)})")
+                if self.telemetry.enabled:
+                    self.telemetry.stop("loop", loop_started)
+                    elapsed = time.time() - start_time
+                    self.telemetry.flush(loop=loop, time=elapsed, sat=satFlag, tree_nodes=DT.tree_.node_count,
+                                         no_train=self.no_train_data, no_test=self.no_test, no_disc=self.no_disc,
+                                         new_test=self.no_test - no_test, new_disc=self.no_disc - no_disc,
+                                         unique_test=len(self.test_index), unique_disc=len(self.disc_index),
+                                         tests_per_sec=self.no_test / elapsed, first_disc_time=self.first_disc_time,
+                                         **({"targets": {target.name: [target.no_test, target.no_disc] for target in self.targets}}
+                                            if len(self.targets) > 1 else {}))
+                if checkpoint_interval is not None and time.time() - last_checkpoint >= checkpoint_interval:
+                    if pending is not None:
+                        # the test cases in flight are executed now, so that their results are part of the checkpoint
+                        batches.append(self.execute_tests(*pending))
+                        pending = None
+                    save_checkpoint(path, dict(self.get_state(), completed=False, loop=loop, elapsed=time.time() - start_time,
+                                               restart_flag=restart_flag, no_new_train_count=no_new_train_count,
+                                               test_sink=[target.test_sink.position() for target in self.targets],
+                                               disc_sink=[target.disc_sink.position() for target in self.targets],
+                                               telemetry=self.telemetry.position()))
+                    last_checkpoint = time.time()
+                for batch in batches:
+                    batch.loop, batch.elapsed = loop, time.time() - start_time
+                    yield batch
+
+            if pending is not None:
+                batch = self.execute_tests(*pending)
+                pending = None
+                batch.loop, batch.elapsed = loop - 1, time.time() - start_time
+                yield batch
+        finally:
+            # also run when the consumer stops the test (GeneratorExit at a yield) or an error is raised
+            runtime = time.time() - start_time
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
 
-        # save the results of detected discriminatory instances and generated test cases
+            self.black_box_model.close()
+            for target in self.targets:
+                target.test_sink.close()
+                target.disc_sink.close()
+            self.telemetry.close()
+            self.telemetry = NullTelemetry()
+        if checkpoint_interval is not None:
+            # only the summary is kept, which marks the test as completed
+            save_checkpoint(path, {"completed": True, "loop": loop - 1, "elapsed": runtime,
+                                   "no_test": self.no_test, "no_disc": self.no_disc, "first_disc_time": self.first_disc_time})
         logging.info(f"The fairness test is completed")
-        logging.info(f"Saving the generated test cases to TestData/{label[0]}-{label[1]}.csv")
-        with open(f'TestData/{label[0]}-{label[1]}.csv', 'w', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile)
-            csvwriter.writerows(self.test_data)
-        logging.info(f"Saving the detected discriminatory instances to DiscData/{label[0]}-{label[1]}.csv")
-        with open(f'DiscData/{label[0]}-{label[1]}.csv', 'w', newline='') as csvfile:
-            csvwriter = csv.writer(csvfile)
-            csvwriter.writerows(self.disc_data)
+        if len(self.targets) > 1:
+            for target in self.targets:
+                logging.info(f"Target {target.name}: #Disc={target.no_disc}, #Test={target.no_test}")
+        if self.first_disc_time is not None:
+            logging.info(f"First discriminatory instance after {self.first_disc_time:.2f}s")
+        logging.info(f"Surrogate: {self.no_fit} fits in {self.fit_time:.2f}s, {(loop - 1) / runtime:.2f} loops/s")
+        if self.vbtx_ver in XOR_SAMPLER_PARAMS:
+            logging.info(f"Encoding cache: {self.encoding_cache_hits} hits")
+        if self.black_box_model.cache is not None:
+            logging.info(f"Prediction cache: {self.black_box_model.cache_info()}")
         logging.info(f"Finished")